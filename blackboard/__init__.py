@@ -1,2 +1,3 @@
 from blackboard.base import *  # NOQA
+from blackboard.document import parse_document  # NOQA
 from blackboard.session import BlackboardSession  # NOQA
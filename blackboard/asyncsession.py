@@ -0,0 +1,163 @@
+import asyncio
+import functools
+import concurrent.futures
+
+from blackboard.session import BlackboardSession
+from blackboard import backend, dwr, logger
+
+
+class AsyncBlackboardSession:
+    """asyncio front-end to a BlackboardSession.
+
+    Requests are executed by the wrapped BlackboardSession in a pool of
+    worker threads, so autologin, WAYF login, HTML redirects and the cookie
+    jar behave exactly as with the blocking API, and cookies obtained by
+    one request are seen by all others. At most max_workers requests are
+    in flight at any time.
+
+    >>> session = BlackboardSession('cookies.txt', 'au123', '_1234_1')
+    >>> with AsyncBlackboardSession(session, max_workers=4) as asession:
+    ...     run_until_complete(asession.map(lambda x: x * 2, range(5)))
+    [0, 2, 4, 6, 8]
+    """
+
+    def __init__(self, session, max_workers=8):
+        assert isinstance(session, BlackboardSession)
+        self.session = session
+        self.max_workers = max_workers
+        self._executor = concurrent.futures.ThreadPoolExecutor(max_workers)
+
+    def close(self):
+        self._executor.shutdown(wait=True)
+
+    def __enter__(self):
+        return self
+
+    def __exit__(self, exc_type, exc_value, traceback):
+        self.close()
+
+    async def run(self, fn, *args, **kwargs):
+        """Run the blocking function fn(*args, **kwargs) in a worker."""
+        loop = asyncio.get_event_loop()
+        return await loop.run_in_executor(
+            self._executor, functools.partial(fn, *args, **kwargs))
+
+    async def call(self, fn, *args, **kwargs):
+        """Run fn(session, *args, **kwargs) in a worker.
+
+        Use this to call the functions in blackboard.backend and
+        blackboard.dwr that take the BlackboardSession as first argument.
+        """
+        return await self.run(fn, self.session, *args, **kwargs)
+
+    async def get(self, url):
+        return await self.run(self.session.get, url)
+
+    async def post(self, url, data, files=None, headers=None,
+                   invalidate=True):
+        return await self.run(
+            self.session.post, url, data, files=files, headers=headers,
+            invalidate=invalidate)
+
+    async def fetch_attempt(self, attempt_id, is_group_assignment):
+        return await self.call(
+            backend.fetch_attempt, attempt_id, is_group_assignment)
+
+    async def fetch_rubric(self, assoc_id, rubric_object):
+        return await self.call(backend.fetch_rubric, assoc_id, rubric_object)
+
+    async def dwr_get_attempts_info(self, attempts):
+        return await self.call(dwr.dwr_get_attempts_info, attempts)
+
+    async def download_file(self, url, filename):
+        return await self.call(backend.download_file, url, filename)
+
+    async def map(self, fn, iterable, limit=None, return_exceptions=False):
+        """Run fn(x) in a worker for each x in iterable.
+
+        Return the list of results in the order of iterable.
+        At most `limit` calls (default: max_workers) run concurrently.
+        If return_exceptions is True, exceptions raised by fn are returned
+        in place of the corresponding result instead of being raised.
+        """
+        semaphore = asyncio.Semaphore(limit or self.max_workers)
+
+        async def bounded(x):
+            async with semaphore:
+                return await self.run(fn, x)
+
+        return await asyncio.gather(
+            *[bounded(x) for x in iterable],
+            return_exceptions=return_exceptions)
+
+
+async def run_pipeline(items, stages, queue_size=None):
+    """Push items through a sequence of stages connected by queues.
+
+    `stages` is a list of (coroutine function, number of workers).
+    Each stage function is called with one item and returns an iterable
+    of items to pass on to the next stage (or None to pass on nothing).
+    Each queue between stages holds at most queue_size items
+    (default: twice the number of workers of the consuming stage).
+
+    An exception raised for one item is logged and does not stop the
+    other items; after all items have been processed, the first
+    exception is raised.
+
+    >>> async def split(s):
+    ...     return s.split()
+    >>> async def shout(s):
+    ...     print(s.upper())
+    >>> run_until_complete(run_pipeline(['hello world'], [(split, 1), (shout, 1)]))
+    HELLO
+    WORLD
+    """
+    queues = [
+        asyncio.Queue(
+            maxsize=0 if i == 0 else queue_size or 2 * n_workers)
+        for i, (fn, n_workers) in enumerate(stages)]
+    errors = []
+
+    async def worker(i, fn):
+        while True:
+            item = await queues[i].get()
+            try:
+                output = await fn(item)
+                if output is not None and i + 1 < len(stages):
+                    for x in output:
+                        await queues[i + 1].put(x)
+            except Exception as exn:
+                logger.exception("Pipeline stage %s failed for %s",
+                                 fn.__name__, item)
+                errors.append(exn)
+            finally:
+                queues[i].task_done()
+
+    for item in items:
+        queues[0].put_nowait(item)
+    workers = [asyncio.ensure_future(worker(i, fn))
+               for i, (fn, n_workers) in enumerate(stages)
+               for _ in range(n_workers)]
+    try:
+        # When queue i has been drained, every item of stage i
+        # has been passed on to queue i + 1.
+        for q in queues:
+            await q.join()
+    finally:
+        for w in workers:
+            w.cancel()
+        await asyncio.gather(*workers, return_exceptions=True)
+    if errors:
+        raise errors[0]
+
+
+def run_until_complete(coro):
+    """Run the coroutine in a fresh event loop and return its result.
+
+    This is the bridge from the blocking API (e.g. Grading) to coroutines.
+    """
+    loop = asyncio.new_event_loop()
+    try:
+        return loop.run_until_complete(coro)
+    finally:
+        loop.close()
@@ -3,15 +3,22 @@ import os
 import re
 import csv
 import json
+import time
 import pprint
-import html5lib
+import pathlib
+import tempfile
+import threading
 import collections
 
 from requests.compat import urljoin, unquote, quote
+from requests.utils import guess_json_utf
 
 import blackboard
 from blackboard import logger, ParserError, BlackboardSession, DOMAIN
 from blackboard.datatable import fetch_datatable
+from blackboard.document import parse_document
+from blackboard.multipart import MultipartEncoder
+from blackboard.jsonstream import IncrementalJsonReader
 from blackboard.elementtext import (
     element_to_markdown, element_text_content, form_field_value,
     html_to_markdown)
@@ -33,7 +40,7 @@ def is_course_id_valid(session, course_id=None):
         'https://%s/webapps/blackboard/execute/' % DOMAIN +
         'courseMain?course_id=%s' % course_id)
     response = session.get(url)
-    document = html5lib.parse(response.content, transport_encoding=response.encoding)
+    document = parse_document(response)
 
     content_panel_path = './/h:div[@id="contentPanel"]'
     content_panel = document.find(content_panel_path, NS)
@@ -57,56 +64,96 @@ def fetch_overview(session):
     l = blackboard.slowlog()
     response = session.get(url)
     l("Fetching gradebook took %.1f s")
+    if response.encoding is None:
+        text = response.content.decode(guess_json_utf(response.content))
+    else:
+        text = response.text
     try:
-        o = response.json()
-    except JSONDecodeError:
+        return parse_overview(text)
+    except KeyError as exn:
+        raise ParserError("No %s" % exn.args[0], response)
+    except ValueError:
         raise ParserError("Couldn't decode JSON", response)
 
-    if 'cachedBook' in o:
-        o = o['cachedBook']
-    try:
-        columns = o['colDefs']
-    except KeyError:
-        raise ParserError("No colDefs", response)
-    assignments = {}
-    for c in columns:
-        if c.get('src') != 'resource/x-bb-assignment':
-            continue
-        assignments[c['id']] = c
 
-    users = {}
-    for row in o['rows']:
-        user_id = row[0]['uid']
-        user_available = row[0]['avail']
+USER_FIELDS = {'FN': 'first_name', 'LN': 'last_name', 'UN': 'username',
+               'SI': 'student_number', 'LA': 'last_access'}
 
-        user_cells = {cell['c']: cell for cell in row if 'c' in cell}
-        user_data = {cell['c']: cell['v'] for cell in row if 'v' in cell}
 
-        user_assignments = {}
+def parse_overview(text):
+    """Parse the getJSONData reply of fetch_overview.
 
-        for a in assignments.keys():
-            try:
-                cell = user_cells[a]
-            except KeyError:
-                continue
-            needs_grading = bool(cell.get('ng'))
-            user_assignments[a] = {
-                'score': cell['v'],
-                'needs_grading': needs_grading,
-                'attempts': None,
-            }
+    The rows of the reply (one per student) are decoded and converted one
+    at a time, so that the decoded reply is never held in memory at once.
+
+    >>> o = parse_overview('''{"colDefs": [
+    ...     {"id": "7", "src": "resource/x-bb-assignment"}, {"id": "FN"}],
+    ...     "rows": [[{"uid": "_1_1", "avail": true}, {"c": "FN", "v": "Ada"},
+    ...               {"c": "LN", "v": "L"}, {"c": "UN", "v": "au1"},
+    ...               {"c": "SI", "v": "1"}, {"c": "LA", "v": 0},
+    ...               {"c": "7", "v": 1, "ng": 1}]]}''')
+    >>> o.students['_1_1']['first_name'], o.students['_1_1']['assignments']
+    ('Ada', {'7': {'score': 1, 'needs_grading': True, 'attempts': None}})
+    """
+    reader = IncrementalJsonReader(text)
+    columns = None
+    # Map assignment ID to colDef
+    assignments = None
+    users = {}
+    # Rows sent before colDefs, if any
+    early_rows = []
 
+    def add_row(row):
+        user_id = row[0]['uid']
+        user_available = row[0]['avail']
+        user_data = {}
+        user_assignments = {}
+        for cell in row:
+            c = cell.get('c')
+            if c in assignments:
+                # Share the key string between all students
+                c = assignment_ids[c]
+                user_assignments[c] = {
+                    'score': cell['v'],
+                    'needs_grading': bool(cell.get('ng')),
+                    'attempts': None,
+                }
+            elif c in USER_FIELDS and 'v' in cell:
+                user_data[USER_FIELDS[c]] = cell['v']
         users[user_id] = dict(
-            first_name=user_data['FN'],
-            last_name=user_data['LN'],
-            username=user_data['UN'],
-            student_number=user_data['SI'],
-            last_access=user_data['LA'],
+            first_name=user_data['first_name'],
+            last_name=user_data['last_name'],
+            username=user_data['username'],
+            student_number=user_data['student_number'],
+            last_access=user_data['last_access'],
             id=user_id,
             available=user_available,
             assignments=user_assignments,
         )
 
+    def read_book():
+        nonlocal columns, assignments, assignment_ids
+        for key in reader.members():
+            if key == 'cachedBook':
+                read_book()
+            elif key == 'colDefs':
+                columns = reader.value()
+                assignments = {c['id']: c for c in columns
+                               if c.get('src') == 'resource/x-bb-assignment'}
+                assignment_ids = {k: k for k in assignments}
+            elif key == 'rows':
+                if assignments is None:
+                    early_rows.extend(reader.items())
+                    continue
+                for row in reader.items():
+                    add_row(row)
+
+    assignment_ids = None
+    read_book()
+    if columns is None:
+        raise KeyError('colDefs')
+    for row in early_rows:
+        add_row(row)
     return fetch_overview.result(assignments, users, columns)
 
 
@@ -119,21 +166,112 @@ class NotYetSubmitted(Exception):
 
 
 def fetch_attempt(session, attempt_id, is_group_assignment):
-    assert isinstance(session, BlackboardSession)
+    response = fetch_attempt_page(session, attempt_id, is_group_assignment)
+    return parse_attempt(response, attempt_id, is_group_assignment)
+
+
+class PageCache:
+    """
+    Short-lived cache of the Forms of pages keyed by URL, used to submit
+    a form from a page that was fetched recently instead of fetching it
+    again.
+
+    Entries expire after `ttl` seconds, which must be well below the
+    lifetime of the nonce in the forms, and each entry can only be
+    taken once, since the nonce is used up when the form is submitted.
+    At most `maxsize` entries are kept.
+
+    >>> cache = PageCache(ttl=60)
+    >>> cache.put('https://example.com/', 'form')
+    >>> cache.pop('https://example.com/')
+    'form'
+    >>> print(cache.pop('https://example.com/'))
+    None
+    """
+
+    def __init__(self, ttl, maxsize=16):
+        self.ttl = ttl
+        self.maxsize = maxsize
+        self._entries = collections.OrderedDict()
+        self._lock = threading.Lock()
+
+    def put(self, url, value):
+        now = time.monotonic()
+        with self._lock:
+            self._entries.pop(url, None)
+            # Entries are in order of insertion, so expired entries
+            # are at the front.
+            while self._entries:
+                t, v = next(iter(self._entries.values()))
+                if now - t <= self.ttl:
+                    break
+                self._entries.popitem(last=False)
+            self._entries[url] = (now, value)
+            while len(self._entries) > self.maxsize:
+                self._entries.popitem(last=False)
+
+    def pop(self, url):
+        """Remove and return the value for url if it is fresh."""
+        with self._lock:
+            try:
+                t, value = self._entries.pop(url)
+            except KeyError:
+                return None
+        if time.monotonic() - t > self.ttl:
+            return None
+        return value
+
+
+# The grading forms are kept for this many seconds
+# so that submit_grade can reuse the page fetched by fetch_attempt.
+GRADING_PAGE_TTL = 5 * 60
+GRADING_FORM_XPATH = './/h:form[@id="currentAttempt_form"]'
+
+
+def get_grading_page_cache(session):
+    try:
+        return session._grading_page_cache
+    except AttributeError:
+        pass
+    return session.__dict__.setdefault(
+        '_grading_page_cache', PageCache(GRADING_PAGE_TTL))
+
+
+def get_grading_page_url(session, attempt_id, is_group_assignment):
     if is_group_assignment:
-        url = ('https://%s/webapps/assignment/' % DOMAIN +
-               'gradeAssignmentRedirector' +
-               '?course_id=%s' % session.course_id +
-               '&groupAttemptId=%s' % attempt_id)
+        return ('https://%s/webapps/assignment/' % DOMAIN +
+                'gradeAssignmentRedirector' +
+                '?course_id=%s' % session.course_id +
+                '&groupAttemptId=%s' % attempt_id)
     else:
-        url = ('https://%s/webapps/assignment/' % DOMAIN +
-               'gradeAssignmentRedirector' +
-               '?course_id=%s' % session.course_id +
-               '&attempt_id=%s' % attempt_id)
+        return ('https://%s/webapps/assignment/' % DOMAIN +
+                'gradeAssignmentRedirector' +
+                '?course_id=%s' % session.course_id +
+                '&attempt_id=%s' % attempt_id)
+
+
+def fetch_attempt_page(session, attempt_id, is_group_assignment):
+    assert isinstance(session, BlackboardSession)
+    url = get_grading_page_url(session, attempt_id, is_group_assignment)
     l = blackboard.slowlog()
-    response = session.get(url)
+    # The page carries the nonce of the grading form, so it is only
+    # reused through the grading page cache, not the memo of session.get.
+    response = session.fetch(url)
     l("Fetching attempt took %.1f s")
-    document = html5lib.parse(response.content, transport_encoding=response.encoding)
+    try:
+        form = Form(session, response, GRADING_FORM_XPATH)
+    except ParserError:
+        # No grading form, e.g. if the attempt is not yet submitted
+        pass
+    else:
+        # Keep only the form fields, not the page and its parsed document
+        form.forget_history()
+        get_grading_page_cache(session).put(url, form)
+    return response
+
+
+def parse_attempt(response, attempt_id, is_group_assignment):
+    document = parse_document(response)
 
     currentAttempt_container = document.find(
         './/h:div[@id="currentAttempt"]', NS)
@@ -287,6 +425,29 @@ def fetch_attempt(session, attempt_id, is_group_assignment):
     )
 
 
+def download_file(session, download_link, filename):
+    """Stream the file at download_link to the given local filename."""
+    # Bypass BlackboardSession.get, which would read the entire body
+    # into memory to look for login forms and HTML redirects.
+    response = session.session.get(download_link, stream=True)
+    response.raise_for_status()
+    # Write to a temporary name so an interrupted download does not
+    # leave a truncated file that looks complete.
+    partial = filename + '.part'
+    try:
+        with open(partial, 'wb') as fp:
+            for chunk in response.iter_content(chunk_size=64*1024):
+                if chunk:
+                    fp.write(chunk)
+        os.replace(partial, filename)
+    except BaseException:
+        try:
+            os.remove(partial)
+        except FileNotFoundError:
+            pass
+        raise
+
+
 def fetch_rubric(session, assoc_id, rubric_object):
     rubric_id = rubric_object['id']
     rubric_title = rubric_object['title']
@@ -301,7 +462,7 @@ def fetch_rubric(session, assoc_id, rubric_object):
     l = blackboard.slowlog()
     response = session.get(url)
     l("Fetching attempt rubric took %.1f s")
-    document = html5lib.parse(response.content, transport_encoding=response.encoding)
+    document = parse_document(response)
 
     def is_desc(div_element):
         classes = (div_element.get('class') or '').split()
@@ -352,16 +513,17 @@ def fetch_rubric(session, assoc_id, rubric_object):
 
 class Form:
     def __init__(self, session, url, form_xpath):
-        # We need to fetch the page to get the nonce
+        # We need to fetch the page to get the nonce. Bypass the memo of
+        # BlackboardSession.get, since a nonce may only be submitted once.
         self._session = session
         if isinstance(url, str):
-            response = session.get(url)
+            response = session.fetch(url)
         else:
             # Presumably a response object
             response = url
             url = response.url
         self._history = response.history + [response]
-        document = html5lib.parse(response.content, transport_encoding=response.encoding)
+        document = parse_document(response)
         form = document.find(form_xpath, NS)
         if form is None:
             raise ParserError("No %s" % form_xpath, response)
@@ -380,6 +542,9 @@ class Form:
         ]
         self._data_lookup = {k: i for i, (k, v) in enumerate(self._data)}
 
+        # List of (name, file) as in the files argument of requests.post,
+        # where the file contents may also be given as a binary file object
+        # or a pathlib.Path; these are streamed instead of read into memory.
         self.files = []
 
     def get(self, k, *args):
@@ -410,19 +575,29 @@ class Form:
             self._data_lookup[k] = len(self._data)
             self._data.append((k, v))
 
+    def forget_history(self):
+        """Drop the references to the fetched page (and its redirects),
+        so that keeping the Form does not keep the page in memory."""
+        self._history = []
+
     def submit(self, post_url=None):
         if post_url is None:
             post_url = self.post_url
             print("POST to", post_url)
         if self.enctype_formdata and not self.files:
             # Blackboard requires the POST to be
-            # Content-Type: multipart/form-data.
-            # Unfortunately, requests can only make a form-data POST
-            # if it has file-like input in the files list.
+            # Content-Type: multipart/form-data, and it expects
+            # at least one file field.
             self.files = [('dummy', io.StringIO(''))]
         try:
             data = [d for d in self._data if d is not None]
-            response = self._session.post(post_url, data=data, files=self.files)
+            if self.files:
+                body = MultipartEncoder(data, self.files)
+                response = self._session.post(
+                    post_url, data=body,
+                    headers={'Content-Type': body.content_type})
+            else:
+                response = self._session.post(post_url, data=data)
         except:
             logger.exception("data=%r files=%r", data, self.files)
             raise
@@ -431,7 +606,7 @@ class Form:
         return response
 
     def _log_badmsg(self, response):
-        document = html5lib.parse(response.content, transport_encoding=response.encoding)
+        document = parse_document(response)
         badmsg = document.find('.//h:span[@id="badMsg1"]', NS)
         if badmsg is not None:
             raise ParserError(
@@ -440,7 +615,7 @@ class Form:
                 'Files:\n%s' % pprint.pformat(self.files))
 
     def require_success_message(self, response):
-        document = html5lib.parse(response.content, transport_encoding=response.encoding)
+        document = parse_document(response)
         msg = document.find('.//h:span[@id="goodMsg1"]', NS)
         if msg is None:
             raise ParserError(
@@ -453,17 +628,13 @@ class Form:
 def submit_grade(session, attempt_id, is_group_assignment,
                  grade, text, filenames, rubrics):
     assert isinstance(session, BlackboardSession)
-    if is_group_assignment:
-        url = ('https://%s/webapps/assignment/' % DOMAIN +
-               'gradeAssignmentRedirector' +
-               '?course_id=%s' % session.course_id +
-               '&groupAttemptId=%s' % attempt_id)
+    url = get_grading_page_url(session, attempt_id, is_group_assignment)
+    # Reuse the grading form if it was fetched recently by fetch_attempt
+    form = get_grading_page_cache(session).pop(url)
+    if form is not None:
+        logger.debug("Reusing grading page of %s", attempt_id)
     else:
-        url = ('https://%s/webapps/assignment/' % DOMAIN +
-               'gradeAssignmentRedirector' +
-               '?course_id=%s' % session.course_id +
-               '&attempt_id=%s' % attempt_id)
-    form = Form(session, url, './/h:form[@id="currentAttempt_form"]')
+        form = Form(session, url, GRADING_FORM_XPATH)
 
     form.set('grade', str(grade))
     form.set('feedbacktext', text)
@@ -491,9 +662,8 @@ def submit_grade(session, attempt_id, is_group_assignment,
             ('feedbackFiles_artifactTypeResourceKey', 'undefined'),
             ('feedbackFiles_linkTitle', base),
         ])
-        with open(filename, 'rb') as fp:
-            fdata = fp.read()
-        form.files.append(('feedbackFiles_LocalFile%d' % i, (base, fdata)))
+        form.files.append(('feedbackFiles_LocalFile%d' % i,
+                           (base, pathlib.Path(filename))))
     if is_group_assignment:
         post_url = (
             'https://%s/webapps/assignment//gradeGroupAssignment/submit' % DOMAIN)
@@ -611,15 +781,18 @@ def upload_csv(session, columns, rows):
     form.set('theFile_attachmentType', 'L')
     base = 'bbfetch.csv'
     form.set('theFile_linkTitle', base)
-    with io.StringIO() as fp:
-        writer = csv.writer(fp)
+    form.pop('theFile_LocalFile0')
+    with tempfile.TemporaryFile() as fp:
+        # Write the CSV to a temporary file that is streamed by submit
+        text = io.TextIOWrapper(fp, encoding='utf-8', newline='')
+        writer = csv.writer(text)
         writer.writerow(columns)
         writer.writerows(rows)
-        fdata = fp.getvalue().encode('utf-8')
-    form.pop('theFile_LocalFile0')
-    form.files.append(('theFile_LocalFile0', (base, fdata)))
-
-    response = form.submit()
+        text.flush()
+        text.detach()
+        fp.seek(0)
+        form.files.append(('theFile_LocalFile0', (base, fp)))
+        response = form.submit()
     assert response.status_code == 200
     form2 = Form(session, response, './/h:form[@name="uploadGradebookForm2"]')
     form2.set('bottom_Submit', 'Submit')
@@ -1,3 +1,4 @@
+import os
 import json
 import time
 import logging
@@ -6,6 +7,8 @@ import datetime
 import importlib
 import collections
 
+from blackboard.store import SqliteStore, is_store_filename
+
 
 logger = logging.getLogger('blackboard')
 
@@ -146,7 +149,40 @@ class Serializable:
                 # a deserialize method
                 setattr(self, k, v)
 
-    def save(self, filename=None):
+    def mark_dirty(self, field, key=None):
+        """
+        Record that self.<field>[key] (or any part of self.<field>,
+        if key is None) has changed since the last save.
+        This allows autosave to write only the changed rows
+        when the state is stored in an SqliteStore.
+        """
+        dirty = self.__dict__.setdefault('_dirty', {})
+        if key is None:
+            dirty[field] = None
+        elif dirty.get(field, ()) is not None:
+            dirty.setdefault(field, set()).add(key)
+
+    def pop_dirty(self, prefix='payload'):
+        """
+        Return and forget the changes recorded by mark_dirty on self and
+        on nested Serializable fields, as a dict keyed by state path.
+        """
+        dirty = {}
+        for field, keys in self.__dict__.pop('_dirty', {}).items():
+            dirty['%s/%s' % (prefix, field)] = keys
+        for f in self.FIELDS:
+            v = getattr(self, f, None)
+            if isinstance(v, Serializable):
+                dirty.update(v.pop_dirty('%s/%s' % (prefix, f)))
+        return dirty
+
+    def get_store(self, filename):
+        store = getattr(self, '_store', None)
+        if store is None or store.filename != filename:
+            store = self._store = SqliteStore(filename)
+        return store
+
+    def save(self, filename=None, dirty=None):
         if filename is None:
             filename = self.filename
         self.filename = filename
@@ -161,18 +197,44 @@ class Serializable:
         else:
             o.append(('course', course_id))
         o.append(('payload', self.serialize()))
-        with open(filename, 'w') as fp:
-            json.dump(collections.OrderedDict(o), fp, indent=2)
+        if dirty is None:
+            # Everything is compared and written, so forget the changes
+            self.pop_dirty()
+        if is_store_filename(filename):
+            self.get_store(filename).save(collections.OrderedDict(o), dirty)
+        else:
+            with open(filename, 'w') as fp:
+                json.dump(collections.OrderedDict(o), fp, indent=2)
 
     def autosave(self):
         filename = getattr(self, 'filename', None)
         if filename is not None:
-            self.save(filename)
+            self.save(filename, dirty=self.pop_dirty())
 
     def initialize_fields(self):
         for k in self.FIELDS:
             setattr(self, k, getattr(self, k, None))
 
+    def read_state(self, filename):
+        """
+        Read the state saved in filename.
+        If filename is an SQLite store that does not exist yet,
+        the corresponding JSON state file (if any) is imported first.
+        """
+        if not is_store_filename(filename):
+            with open(filename) as fp:
+                return json.load(fp)
+        if not os.path.exists(filename):
+            json_filename = os.path.splitext(filename)[0] + '.json'
+            if not os.path.exists(json_filename):
+                raise FileNotFoundError(filename)
+            logger.info("Importing %s into %s", json_filename, filename)
+            self.get_store(filename).import_json(json_filename)
+        o = self.get_store(filename).load()
+        if o is None:
+            raise FileNotFoundError(filename)
+        return o
+
     def load(self, filename=None, refresh=True):
         if filename is None:
             filename = self.filename
@@ -181,16 +243,14 @@ class Serializable:
                              type(self).__name__)
         if refresh:
             try:
-                with open(filename) as fp:
-                    o = json.load(fp)
+                o = self.read_state(filename)
             except FileNotFoundError:
                 self.initialize_fields()
                 self.refresh()
                 self.save(filename=filename)
                 return
         else:
-            with open(filename) as fp:
-                o = json.load(fp)
+            o = self.read_state(filename)
         if 'course' in o:
             course_id = self.session.course_id
             if course_id != o['course']:
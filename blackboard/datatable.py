@@ -1,9 +1,9 @@
 import re
 import csv
-import html5lib
 from requests.compat import urljoin
 
 import blackboard
+from blackboard.document import parse_document
 from blackboard.elementtext import element_text_content
 
 
@@ -38,7 +38,7 @@ def iter_datatable(session, url, **kwargs):
     if kwargs.pop('edit_mode', False):
         response = session.ensure_edit_mode(response)
     history = list(response.history) + [response]
-    document = html5lib.parse(response.content, transport_encoding=response.encoding)
+    document = parse_document(response)
     keys, rows = parse_datatable(response, document, **kwargs)
     yield keys
     yield from rows
@@ -56,7 +56,7 @@ def iter_datatable(session, url, **kwargs):
         response = session.get(url)
         l("Fetching datatable page %d took %.4f s", page_number)
         history += list(response.history) + [response]
-        document = html5lib.parse(response.content, transport_encoding=response.encoding)
+        document = parse_document(response)
         keys_, rows = parse_datatable(response, document, **kwargs)
         if keys != keys_:
             raise ValueError(
@@ -0,0 +1,92 @@
+import html5lib
+
+from blackboard.base import logger
+
+
+def _parse_html5lib(content, encoding):
+    return html5lib.parse(content, transport_encoding=encoding)
+
+
+def _parse_html5_parser(content, encoding):
+    # html5-parser is a C implementation of the HTML5 parsing algorithm
+    # (gumbo). With treebuilder='etree' and namespace_elements=True
+    # it returns the same xml.etree.ElementTree structure as html5lib,
+    # so NS-qualified queries and element_text_content work unchanged.
+    import html5_parser
+    return html5_parser.parse(
+        content, transport_encoding=encoding,
+        treebuilder='etree', namespace_elements=True)
+
+
+# Parsers in order of preference.
+# Note that lxml's own HTML parser (lxml.html) is not offered, since it
+# does not implement the HTML5 tree construction rules (for instance, it
+# does not insert the implied <tbody> that our table queries rely on),
+# and lxml.html.html5parser simply delegates to html5lib.
+PARSERS = [
+    ('html5-parser', 'html5_parser', _parse_html5_parser),
+    ('html5lib', 'html5lib', _parse_html5lib),
+]
+
+_parser = None
+
+
+def get_html_parser():
+    """Return (name, function) of the HTML parser used by parse_document.
+
+    The fastest installed parser is chosen the first time this is called.
+    """
+    global _parser
+    if _parser is None:
+        for name, module, fn in PARSERS:
+            try:
+                __import__(module)
+            except (ImportError, RuntimeError) as exn:
+                # html5_parser raises RuntimeError when it is linked
+                # against a different libxml2 than lxml.
+                logger.debug("HTML parser %s unavailable: %s", name, exn)
+                continue
+            _parser = (name, fn)
+            break
+    return _parser
+
+
+def set_html_parser(name):
+    """Force parse_document to use the HTML parser with the given name."""
+    global _parser
+    for n, module, fn in PARSERS:
+        if n == name:
+            __import__(module)
+            _parser = (n, fn)
+            return
+    raise ValueError("Unknown HTML parser %r; must be one of %s" %
+                     (name, ', '.join(n for n, m, f in PARSERS)))
+
+
+def parse_html(content, encoding=None):
+    """Parse an HTML document (bytes) into an ElementTree element.
+
+    >>> NS = {'h': 'http://www.w3.org/1999/xhtml'}
+    >>> document = parse_html(b'<table><tr><td id="x">42</td></tr></table>')
+    >>> document.find('.//h:table/h:tbody/h:tr/h:td', NS).get('id')
+    'x'
+    """
+    name, fn = get_html_parser()
+    return fn(content, encoding)
+
+
+def parse_document(response):
+    """Parse the HTML body of a requests.Response into an ElementTree.
+
+    The parsed document is cached on the response object, so the session
+    helpers (follow_html_redirect, detect_login, log_error) and the caller
+    share a single tree instead of each parsing the body from scratch.
+    The returned tree must therefore be treated as read-only.
+    """
+    try:
+        return response._bbfetch_document
+    except AttributeError:
+        pass
+    document = parse_html(response.content, response.encoding)
+    response._bbfetch_document = document
+    return document
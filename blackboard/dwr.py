@@ -1,7 +1,11 @@
 import re
 import ast
 import sys
+import time
 import collections
+import concurrent.futures
+
+import requests
 
 import blackboard
 import blackboard.backend
@@ -89,6 +93,218 @@ def get_script_session_id(session):
     return session._script_session_id
 
 
+class DwrReplyParser:
+    """
+    Single-pass interpreter for the JavaScript that DWR sends in replies.
+
+    The reply is a sequence of statements of the following forms:
+
+        throw '...';
+        // comment
+        var s0=VALUE;
+        s0.field=VALUE;
+        s0[VALUE]=VALUE;
+        dwr.engine._remoteHandleCallback('BATCH','CALL',VALUE);
+        dwr.engine._remoteHandleException('BATCH','CALL',VALUE);
+
+    where VALUE is a JavaScript literal (null, true, false, number, string,
+    array or object literal) or the name of a variable assigned earlier.
+    The reply is scanned once from left to right, building the table of
+    variables as it goes. Assignments of plain scalars to fields, which make
+    up most of a reply, are handled by a single regular expression match.
+    """
+
+    # Whitespace and comments
+    _SKIP = r'(?:\s+|//[^\n]*)*'
+    TOKEN = re.compile(_SKIP + r"""(?:
+        (?P<str>"(?:[^"\\]|\\.)*"|'(?:[^'\\]|\\.)*')
+        |(?P<num>-?(?:\d+\.?\d*|\.\d+)(?:[eE][-+]?\d+)?)
+        |(?P<name>[A-Za-z_$][\w$]*(?:\.[A-Za-z_$][\w$]*)*)
+        |(?P<punct>[][=;,:{}()])
+        )""", re.X | re.S)
+    # Fast path for the most common statement, s0.field=SCALAR;
+    # where SCALAR is a string without escapes, a number or a constant.
+    SETATTR = re.compile(_SKIP + r"""
+        ([A-Za-z_$][\w$]*)\.([A-Za-z_$][\w$]*)=
+        (?:"([^"\\]*)"|(-?\d+)|(-?\d+\.\d+)|(null|true|false));
+        """, re.X)
+    END = re.compile(_SKIP + r'\Z')
+
+    ESCAPE = re.compile(r'\\(u[0-9a-fA-F]{4}|x[0-9a-fA-F]{2}|.)', re.S)
+    SIMPLE_ESCAPES = {'n': '\n', 't': '\t', 'r': '\r', 'b': '\b',
+                      'f': '\f', 'v': '\v', '0': '\0'}
+    CONSTANTS = {'null': None, 'true': True, 'false': False}
+
+    def __init__(self, code):
+        self.code = code
+        self.pos = 0
+        self.locals = {}
+        self.results = []
+        self.exceptions = []
+
+    def error(self, msg, pos=None):
+        if pos is None:
+            pos = self.pos
+        context = self.code[pos:pos + 60].strip()
+        raise ValueError("%s; did not parse %r" % (msg, context))
+
+    def next(self):
+        """Consume the next token and return (kind, text)."""
+        mo = self.TOKEN.match(self.code, self.pos)
+        if mo is None:
+            self.error("Unexpected input")
+        self.pos = mo.end()
+        return mo.lastgroup, mo.group(mo.lastgroup)
+
+    def peek(self):
+        mo = self.TOKEN.match(self.code, self.pos)
+        if mo is not None:
+            return mo.group(mo.lastgroup)
+
+    def expect(self, text):
+        pos = self.pos
+        kind, value = self.next()
+        if value != text:
+            self.error("Expected %r" % (text,), pos)
+
+    def unescape(self, s):
+        s = s[1:-1]
+        if '\\' not in s:
+            return s
+
+        def repl(mo):
+            e = mo.group(1)
+            if len(e) > 1:
+                return chr(int(e[1:], 16))
+            return self.SIMPLE_ESCAPES.get(e, e)
+
+        return self.ESCAPE.sub(repl, s)
+
+    def value(self):
+        pos = self.pos
+        kind, token = self.next()
+        if kind == 'str':
+            return self.unescape(token)
+        elif kind == 'num':
+            if '.' in token or 'e' in token or 'E' in token:
+                return float(token)
+            return int(token)
+        elif kind == 'name':
+            try:
+                return self.CONSTANTS[token]
+            except KeyError:
+                pass
+            try:
+                return self.locals[token]
+            except KeyError:
+                self.error("Unknown variable %r" % (token,), pos)
+        elif token == '[':
+            items = []
+            while self.peek() != ']':
+                items.append(self.value())
+                if self.peek() != ']':
+                    self.expect(',')
+            self.expect(']')
+            return items
+        elif token == '{':
+            items = collections.OrderedDict()
+            while self.peek() != '}':
+                key_pos = self.pos
+                kind, key = self.next()
+                if kind == 'str':
+                    key = self.unescape(key)
+                elif kind not in ('name', 'num'):
+                    self.error("Expected object key", key_pos)
+                self.expect(':')
+                items[key] = self.value()
+                if self.peek() != '}':
+                    self.expect(',')
+            self.expect('}')
+            return items
+        self.error("Expected value", pos)
+
+    def variable(self, name, pos):
+        try:
+            return self.locals[name]
+        except KeyError:
+            self.error("Unknown variable %r" % (name,), pos)
+
+    def statement(self):
+        mo = self.SETATTR.match(self.code, self.pos)
+        if mo is not None:
+            name, key, s, i, f, c = mo.groups()
+            if s is not None:
+                v = s
+            elif i is not None:
+                v = int(i)
+            elif f is not None:
+                v = float(f)
+            else:
+                v = self.CONSTANTS[c]
+            self.variable(name, self.pos)[key] = v
+            self.pos = mo.end()
+            return
+
+        pos = self.pos
+        kind, token = self.next()
+        if kind != 'name':
+            self.error("Expected statement", pos)
+        if token == 'throw':
+            self.value()
+        elif token == 'var':
+            kind, name = self.next()
+            self.expect('=')
+            self.locals[name] = self.value()
+        elif token in ('dwr.engine._remoteHandleCallback',
+                       'dwr.engine._remoteHandleException'):
+            self.expect('(')
+            batch_id = int(self.value())
+            self.expect(',')
+            call_id = int(self.value())
+            self.expect(',')
+            data = self.value()
+            self.expect(')')
+            if token == 'dwr.engine._remoteHandleCallback':
+                if isinstance(data, dict):
+                    data = list(data.items())
+                self.results.append((batch_id, call_id, data))
+            else:
+                self.exceptions.append(
+                    (batch_id, call_id, data['javaClassName'],
+                     data['message']))
+        elif self.peek() == '[':
+            self.expect('[')
+            key = self.value()
+            self.expect(']')
+            self.expect('=')
+            self.setitem(self.variable(token, pos), key, self.value())
+        else:
+            name, dot, key = token.partition('.')
+            if not dot or '.' in key:
+                self.error("Unknown statement %r" % (token,), pos)
+            self.expect('=')
+            self.variable(name, pos)[key] = self.value()
+        if not self.at_end():
+            self.expect(';')
+
+    def at_end(self):
+        return self.END.match(self.code, self.pos) is not None
+
+    @staticmethod
+    def setitem(container, key, value):
+        if isinstance(container, list) and len(container) <= key:
+            container.extend([None] * (key - len(container)))
+            container.append(value)
+        else:
+            # Either a dictionary or a list with length > key
+            container[key] = value
+
+    def parse(self):
+        while not self.at_end():
+            self.statement()
+        return self.results, self.exceptions
+
+
 def parse_js(code):
     '''
     Parse the server response from DWR.
@@ -134,6 +350,12 @@ def parse_js(code):
     ... dwr.engine._remoteHandleCallback('16','1234',{'42':s3});
     ... """)
     {1234: [('42', [1234, 2345])]}
+    >>> results = parse_js(r"""
+    ... var s0={};s0.name="\\u00c6bler \\"1\\"";s0.n=-2;s0['a b']=[1.5,null];
+    ... dwr.engine._remoteHandleCallback('16','7',[s0]);
+    ... """)
+    >>> dict(results[7][0])
+    {'name': 'Æbler "1"', 'n': -2, 'a b': [1.5, None]}
     >>> parse_js("""
     ... dwr.engine._remoteHandleException('42','5',{javaClassName:\\
     ... "java.lang.Throwable",message:"Error"});
@@ -143,6 +365,20 @@ def parse_js(code):
     ValueError: DWR returned exceptions: [(42, 5, 'java.lang...', 'Error')]
     '''
 
+    results, exceptions = DwrReplyParser(code).parse()
+    if exceptions:
+        raise ValueError("DWR returned exceptions: %r" % (exceptions,))
+
+    return {call_id: data for batch_id, call_id, data in results}
+
+
+def parse_js_regex(code):
+    """
+    Parse the server response from DWR using regular expressions and
+    js_object_parse. This was the implementation of parse_js before
+    DwrReplyParser; it is kept as a reference for benchmark_parse_js.
+    """
+
     id = r'[a-zA-Z_][a-zA-Z0-9_]*'
     obj = r'(?:[^;\'"]|\'(?:[^\\\']|\\.)*\'|"(?:[^\\"]|\\.)*")*'
     kv = '(?:' + obj + '):(?:' + id + ')'
@@ -255,7 +491,7 @@ def dwr_get_attempts_info_single_request(session, attempts):
 
     url = ('https://%s/webapps/gradebook/dwr/call/plaincall/' % DOMAIN +
            'GradebookDWRFacade.getAttemptsInfo.dwr')
-    response = session.post(url, payload)
+    response = session.post(url, payload, invalidate=False)
     try:
         results = parse_js(response.text)
     except ValueError as exn:
@@ -263,14 +499,115 @@ def dwr_get_attempts_info_single_request(session, attempts):
     return [results[i] for i in range(len(attempts))]
 
 
-def dwr_get_attempts_info(session, attempts, batch_size=20):
-    results = []
-    for i in range(0, len(attempts), batch_size):
-        j = min(len(attempts), i + batch_size)
+class AdaptiveBatchSize:
+    """
+    Choose the number of DWR calls to send in each request.
+
+    The batch size grows additively while the round-trip time stays close
+    to the fastest round-trip seen so far, and is halved when a request
+    fails or is much slower than that.
+
+    >>> b = AdaptiveBatchSize(20)
+    >>> b.record(20, 1.0)
+    >>> b.size
+    30
+    >>> b.record(30, 1.2)
+    >>> b.size
+    40
+    >>> b.record(40, 5.0)
+    >>> b.size
+    20
+    >>> b.record(20, None)
+    >>> b.size
+    10
+    """
+
+    def __init__(self, size=20, minimum=1, maximum=200, increase=10,
+                 flat_factor=1.5, slow_factor=3.0):
+        self.size = size
+        self.minimum = minimum
+        self.maximum = maximum
+        self.increase = increase
+        self.flat_factor = flat_factor
+        self.slow_factor = slow_factor
+        self.fastest = None
+
+    def record(self, n, elapsed):
+        """Record that a request of n calls took elapsed seconds.
+
+        Pass elapsed=None if the request failed.
+        """
+        if elapsed is None:
+            self._decrease()
+            return
+        if self.fastest is None or elapsed < self.fastest:
+            self.fastest = elapsed
+        if elapsed > self.slow_factor * self.fastest:
+            self._decrease()
+        elif elapsed <= self.flat_factor * self.fastest and n >= self.size:
+            self.size = min(self.maximum, self.size + self.increase)
+
+    def _decrease(self):
+        self.size = max(self.minimum, self.size // 2)
+
+
+def dwr_get_attempts_info(session, attempts, batch_size=20, concurrency=4,
+                          max_retries=3):
+    """
+    Call getAttemptsInfo for each (student_id, handin_id) in attempts,
+    and return the results in the same order.
+
+    The calls are sent in batches of adaptive size (see AdaptiveBatchSize),
+    with up to `concurrency` requests in flight at a time.
+    A failed batch is retried in smaller batches; after max_retries
+    failed requests in total, the error is raised.
+    """
+    sizer = AdaptiveBatchSize(batch_size)
+    results = [None] * len(attempts)
+    # Fetch once before sending requests concurrently
+    get_script_session_id(session)
+
+    def fetch(i, j):
+        t = time.time()
         l = blackboard.slowlog()
-        results.extend(
-            dwr_get_attempts_info_single_request(session, attempts[i:j]))
+        data = dwr_get_attempts_info_single_request(session, attempts[i:j])
         l("Fetching %d attempt lists took %%.1f s" % (j - i))
+        return time.time() - t, data
+
+    # Index ranges of attempts not yet sent
+    todo = collections.deque([(0, len(attempts))] if attempts else [])
+    failures = 0
+    error = None
+    with concurrent.futures.ThreadPoolExecutor(concurrency) as executor:
+        running = {}
+        while (todo and error is None) or running:
+            while todo and error is None and len(running) < concurrency:
+                i, j = todo.popleft()
+                k = min(j, i + sizer.size)
+                if k < j:
+                    todo.appendleft((k, j))
+                running[executor.submit(fetch, i, k)] = (i, k)
+            done, not_done = concurrent.futures.wait(
+                running, return_when=concurrent.futures.FIRST_COMPLETED)
+            for f in done:
+                i, j = running.pop(f)
+                try:
+                    elapsed, data = f.result()
+                except (ParserError, requests.RequestException) as exn:
+                    sizer.record(j - i, None)
+                    failures += 1
+                    if failures > max_retries:
+                        error = error or exn
+                        continue
+                    logger.warning(
+                        "Fetching %d attempt lists failed (%s); " +
+                        "retrying in batches of %d", j - i, exn, sizer.size)
+                    todo.appendleft((i, j))
+                    continue
+                sizer.record(j - i, elapsed)
+                results[i:j] = data
+    if error is not None:
+        raise error
     return results
 
 
@@ -293,9 +630,75 @@ def dwr_get_groups(session):
     payload.update(('c%d-%s' % (i, k), v) for k, v in call_data.items())
     url = ('https://%s/webapps/gradebook/dwr/call/plaincall/' % DOMAIN +
            'GradebookDWRFacade.getGroups.dwr')
-    response = session.post(url, payload)
+    response = session.post(url, payload, invalidate=False)
     try:
         results = parse_js(response.text)
     except ValueError as exn:
         raise ParserError(exn.args[0], response)
     return results[i]
+
+
+def _synthetic_reply(calls=20, attempts=5):
+    """A reply to a dwr_get_attempts_info batch of the given size."""
+    statements = []
+    callbacks = []
+    n = 0
+    for c in range(calls):
+        names = []
+        for a in range(attempts):
+            s = 's%d' % n
+            n += 1
+            names.append(s)
+            statements.append(
+                'var %s={};%s.date="24/11/15";%s.exempt=false;' % (s, s, s) +
+                '%s.groupAttemptId="_%d_1";' % (s, 17000 + n) +
+                '%s.groupName="Hand In Group %d";' % (s, c) +
+                '%s.groupScore=1.0;%s.groupStatus="ng";' % (s, s) +
+                '%s.id="_%d_1";%s.override=false;' % (s, 181000 + n, s) +
+                '%s.score=0.0;%s.status=null;' % (s, s))
+        callbacks.append("dwr.engine._remoteHandleCallback('42','%d',[%s]);" %
+                         (c, ','.join(names)))
+    return ("throw 'allowScriptTagRemoting is false.';\n" +
+            "//#DWR-INSERT\n//#DWR-REPLY\n" +
+            '\n'.join(statements + callbacks) + '\n')
+
+
+def benchmark_parse_js(number=200):
+    """
+    Compare parse_js with parse_js_regex on the DWR replies from the
+    doctests of parse_js and on a synthetic reply to a batch of 20 calls.
+    """
+    import io
+    import timeit
+    import doctest
+    import contextlib
+
+    replies = []
+    for example in doctest.DocTestParser().get_examples(parse_js.__doc__):
+        for node in ast.walk(ast.parse(example.source)):
+            if (isinstance(node, ast.Call) and
+                    getattr(node.func, 'id', None) == 'parse_js'):
+                replies.append(ast.literal_eval(node.args[0]))
+    replies.append(_synthetic_reply())
+
+    def run(fn, reply):
+        try:
+            return fn(reply)
+        except ValueError as exn:
+            return exn.args
+
+    for reply in replies:
+        # JsObjectParser prints a backtrace for syntax it does not support.
+        with contextlib.redirect_stderr(io.StringIO()):
+            expected = run(parse_js_regex, reply)
+        if repr(run(parse_js, reply)) != repr(expected):
+            print("%6d bytes: results differ, skipped" % len(reply))
+            continue
+        times = [timeit.timeit(lambda: run(fn, reply), number=number) / number
+                 for fn in (parse_js_regex, parse_js)]
+        print("%6d bytes: regex+ast %8.1f us, single-pass %8.1f us (%.1fx)" %
+              (len(reply), times[0] * 1e6, times[1] * 1e6,
+               times[0] / times[1]))
+
+if __name__ == '__main__':
+    benchmark_parse_js()
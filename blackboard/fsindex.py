@@ -0,0 +1,201 @@
+import os
+import time
+import errno
+import struct
+import ctypes
+import ctypes.util
+
+from blackboard.base import logger
+
+
+class Inotify:
+    """Minimal non-blocking binding of the Linux inotify API.
+
+    Raises OSError if inotify is not available.
+    """
+
+    IN_MOVED_FROM = 0x40
+    IN_MOVED_TO = 0x80
+    IN_CREATE = 0x100
+    IN_DELETE = 0x200
+    IN_DELETE_SELF = 0x400
+    IN_MOVE_SELF = 0x800
+    IN_Q_OVERFLOW = 0x4000
+    IN_IGNORED = 0x8000
+    IN_ONLYDIR = 0x1000000
+
+    # Changes to the list of entries of a directory
+    DIRECTORY_EVENTS = (IN_MOVED_FROM | IN_MOVED_TO | IN_CREATE | IN_DELETE |
+                        IN_DELETE_SELF | IN_MOVE_SELF | IN_ONLYDIR)
+
+    EVENT = struct.Struct('iIII')
+
+    def __init__(self):
+        try:
+            # IN_NONBLOCK and IN_CLOEXEC; os.O_NONBLOCK is missing on Windows
+            flags = os.O_NONBLOCK | os.O_CLOEXEC
+        except AttributeError:
+            raise OSError("inotify not supported")
+        name = ctypes.util.find_library('c')
+        if name is None:
+            raise OSError("libc not found")
+        libc = ctypes.CDLL(name, use_errno=True)
+        try:
+            self._add_watch = libc.inotify_add_watch
+            init = libc.inotify_init1
+        except AttributeError:
+            raise OSError("inotify not supported")
+        self._add_watch.argtypes = [ctypes.c_int, ctypes.c_char_p,
+                                    ctypes.c_uint32]
+        self.fd = init(flags)
+        if self.fd < 0:
+            e = ctypes.get_errno()
+            raise OSError(e, os.strerror(e))
+
+    def close(self):
+        os.close(self.fd)
+
+    def add_watch(self, path, mask=DIRECTORY_EVENTS):
+        wd = self._add_watch(self.fd, os.fsencode(path), mask)
+        if wd < 0:
+            e = ctypes.get_errno()
+            raise OSError(e, os.strerror(e), path)
+        return wd
+
+    def read(self):
+        """Return the list of pending (wd, mask) events."""
+        events = []
+        while True:
+            try:
+                buf = os.read(self.fd, 64 * 1024)
+            except BlockingIOError:
+                return events
+            i = 0
+            while i < len(buf):
+                wd, mask, cookie, length = self.EVENT.unpack_from(buf, i)
+                events.append((wd, mask))
+                i += self.EVENT.size + length
+
+
+class DirectoryIndex:
+    """
+    Cache of directory listings, used to answer "does this file exist"
+    for many files in a few directories without a stat call per file.
+
+    Each directory is listed once, and listed again only when its mtime
+    changes (creating, deleting or renaming an entry changes the mtime
+    of the directory). If inotify is available, the listed directories
+    are watched, and cached listings are used without even a stat call
+    until an event is received for the directory. Note that inotify does
+    not see changes made on other machines to a network file system;
+    use DirectoryIndex(use_inotify=False) if that is a concern.
+
+    >>> import tempfile
+    >>> d = tempfile.mkdtemp()
+    >>> index = DirectoryIndex()
+    >>> index.exists(os.path.join(d, 'comments.txt'))
+    False
+    >>> open(os.path.join(d, 'comments.txt'), 'w').close()
+    >>> index.exists(os.path.join(d, 'comments.txt'))
+    True
+    >>> index.isdir(os.path.join(d, 'missing'))
+    False
+    """
+
+    # A listing taken less than this many seconds after the directory
+    # was modified is not trusted, since a file created in the same
+    # timestamp tick would not change the mtime of the directory.
+    racy_interval = 2
+
+    def __init__(self, use_inotify=True):
+        # Map path to (mtime_ns, frozenset of names)
+        self._entries = {}
+        self._use_inotify = use_inotify
+        self._inotify = None
+        # Map watched path to watch descriptor and back
+        self._watched = {}
+        self._watch_paths = {}
+
+    def close(self):
+        if self._inotify is not None:
+            self._inotify.close()
+            self._inotify = None
+        self._watched.clear()
+        self._watch_paths.clear()
+
+    def _get_inotify(self):
+        if self._inotify is None and self._use_inotify:
+            try:
+                self._inotify = Inotify()
+            except OSError as exn:
+                logger.debug("inotify unavailable: %s", exn)
+                self._use_inotify = False
+        return self._inotify
+
+    def _process_events(self):
+        for wd, mask in self._inotify.read():
+            if mask & Inotify.IN_Q_OVERFLOW:
+                self._entries.clear()
+                continue
+            path = self._watch_paths.get(wd)
+            if path is None:
+                continue
+            self._entries.pop(path, None)
+            if mask & (Inotify.IN_IGNORED | Inotify.IN_DELETE_SELF |
+                       Inotify.IN_MOVE_SELF):
+                # The watch is removed (or no longer watches path).
+                del self._watch_paths[wd]
+                del self._watched[path]
+
+    def _watch(self, path):
+        inotify = self._get_inotify()
+        if inotify is None or path in self._watched:
+            return
+        try:
+            wd = inotify.add_watch(path)
+        except OSError as exn:
+            if exn.errno == errno.ENOSPC:
+                logger.debug("inotify watch limit reached")
+            return
+        self._watched[path] = wd
+        self._watch_paths[wd] = path
+
+    def invalidate(self, path=None):
+        """Forget the listing of path (default: all directories)."""
+        if path is None:
+            self._entries.clear()
+        else:
+            self._entries.pop(path, None)
+
+    def listdir(self, path):
+        """Return the frozenset of names in the directory path,
+        or None if path is not a directory."""
+        if self._inotify is not None:
+            self._process_events()
+            if path in self._watched and path in self._entries:
+                return self._entries[path][1]
+        try:
+            st = os.stat(path)
+        except OSError:
+            return None
+        cached = self._entries.get(path)
+        if cached is not None and cached[0] == st.st_mtime_ns:
+            return cached[1]
+        # Watch before listing, so that no change is missed.
+        self._watch(path)
+        try:
+            names = frozenset(os.listdir(path))
+        except NotADirectoryError:
+            return None
+        if (path in self._watched or
+                time.time() - st.st_mtime > self.racy_interval):
+            self._entries[path] = (st.st_mtime_ns, names)
+        return names
+
+    def isdir(self, path):
+        return self.listdir(path) is not None
+
+    def exists(self, path):
+        directory, name = os.path.split(path)
+        names = self.listdir(directory or os.curdir)
+        return names is not None and name in names
@@ -1,6 +1,7 @@
 import time
 import textwrap
 import collections
+import concurrent.futures
 
 import blackboard
 from blackboard import BlackboardSession, logger, DOMAIN
@@ -18,6 +19,16 @@ def get_handin_attempt_counts(session, handin_id):
     return o
 
 
+def fetch_attempt_counts(session, handin_ids, concurrency=4):
+    """Return a dict mapping each handin id to get_handin_attempt_counts."""
+    handin_ids = list(handin_ids)
+    with concurrent.futures.ThreadPoolExecutor(concurrency) as executor:
+        counts = executor.map(
+            lambda handin_id: get_handin_attempt_counts(session, handin_id),
+            handin_ids)
+        return dict(zip(handin_ids, counts))
+
+
 class DictWrapper:
     """
     Wrapper around a dictionary of objects.
@@ -43,8 +54,20 @@ class DictWrapper:
 
     >>> print(foos['bar'])
     Foo(inner=('bar', 2), meta=42, data_key='bar')
+
+    Each object is only wrapped once, until it is replaced
+    in the underlying dictionary.
+
+    >>> foos['bar'] is foos['bar']
+    True
+    >>> foo_data['bar'] = ('bar', 4)
+    >>> print(foos['bar'])
+    Foo(inner=('bar', 4), meta=42, data_key='bar')
     """
 
+    __slots__ = ('_item_class', '_data', '_order_by', '_kwargs',
+                 '_items', '_keys', '_values')
+
     def __init__(self, item_class, data, order_by=None, **kwargs):
         self._item_class = item_class
         self._data = data
@@ -52,38 +75,50 @@ class DictWrapper:
             order_by = self._item_class.ordering
         self._order_by = order_by
         self._kwargs = kwargs
+        # Map each key to (raw object, wrapped object)
+        self._items = {}
+        self._keys = self._values = None
 
     def __len__(self):
-        try:
-            return len(self._items)
-        except AttributeError:
-            return len(self._data)
+        return len(self._data)
 
     def _init(self):
-        self._values = [self._item_class(v, data_key=k, **self._kwargs)
-                        for k, v in self._data.items()]
-        self._values.sort(key=self._order_by)
-        self._keys = [x._kwargs['data_key'] for x in self._values]
+        items = [(k, self[k]) for k in self._data]
+        items.sort(key=lambda item: self._order_by(item[1]))
+        self._keys = [k for k, v in items]
+        self._values = [v for k, v in items]
 
-    def values(self):
-        try:
-            return iter(self._values)
-        except AttributeError:
+    def _sorted(self):
+        if self._values is None or len(self._values) != len(self._data):
             self._init()
-            return iter(self._values)
+
+    def values(self):
+        self._sorted()
+        return iter(self._values)
 
     def items(self):
-        try:
-            return zip(self._keys, self._values)
-        except AttributeError:
-            self._init()
-            return zip(self._keys, self._values)
+        self._sorted()
+        return zip(self._keys, self._values)
 
     def __getitem__(self, key):
-        return self._item_class(self._data[key], data_key=key, **self._kwargs)
+        data = self._data[key]
+        try:
+            prev, item = self._items[key]
+        except KeyError:
+            pass
+        else:
+            if prev is data:
+                return item
+            # The object was replaced, so the sorted view may be stale.
+            self._values = None
+        item = self._item_class(data, data_key=key, **self._kwargs)
+        self._items[key] = (data, item)
+        return item
 
 
 class ItemWrapper:
+    __slots__ = ('_data', '_kwargs')
+
     id = property(lambda self: self['id'])
 
     @staticmethod
@@ -130,16 +165,25 @@ class Student(ItemWrapper):
     'au123'
     """
 
+    __slots__ = ('_assignments',)
+
     first_name = property(lambda self: self['first_name'])
     last_name = property(lambda self: self['last_name'])
     username = property(lambda self: self['username'])
     student_number = property(lambda self: self['student_number'])
 
+    def __init__(self, data, **kwargs):
+        super().__init__(data, **kwargs)
+        self._assignments = None
+
     @property
     def assignments(self):
-        return DictWrapper(StudentAssignment, self['assignments'],
-                           student=self,
-                           assignments=self._kwargs['assignments'])
+        view = self._assignments
+        if view is None or view._data is not self['assignments']:
+            view = self._assignments = DictWrapper(
+                StudentAssignment, self['assignments'], student=self,
+                assignments=self._kwargs['assignments'])
+        return view
 
     @property
     def name(self):
@@ -184,6 +228,8 @@ class Assignment(ItemWrapper):
     Aflevering 3
     """
 
+    __slots__ = ()
+
     name = property(lambda self: self['name'])
 
     @property
@@ -198,6 +244,8 @@ class Assignment(ItemWrapper):
 
 
 class Attempt(ItemWrapper):
+    __slots__ = ()
+
     id = property(lambda self:
                   self['groupAttemptId']
                   if self.assignment.group_assignment
@@ -260,9 +308,15 @@ class Attempt(ItemWrapper):
 
 
 class StudentAssignment(ItemWrapper):
+    __slots__ = ('_assignment', '_attempts_data', '_attempts')
+
     id = property(lambda self: self._kwargs['data_key'])
     student = property(lambda self: self._kwargs['student'])
     needs_grading = property(lambda self: self['needs_grading'])
+    # Used by every Attempt property, so avoid going through __getattr__.
+    group_assignment = property(
+        lambda self: self._assignment.group_assignment)
+    name = property(lambda self: self._assignment.name)
 
     @property
     def score(self):
@@ -275,15 +329,32 @@ class StudentAssignment(ItemWrapper):
     def ordering(item):
         return 0  # Don't sort StudentAssignments
 
+    def __init__(self, data, **kwargs):
+        super().__init__(data, **kwargs)
+        self._assignment = self._kwargs['assignments'][self.id]
+        self._attempts_data = self._attempts = None
+
     def __getattr__(self, key):
-        return getattr(self._kwargs['assignments'][self.id], key)
+        if key.startswith('_'):
+            raise AttributeError(key)
+        return getattr(self._assignment, key)
 
     @property
     def cached_attempts(self):
+        """The attempts, or None if they have not been fetched.
+
+        The list is cached until the attempts are replaced,
+        so it must not be modified.
+        """
         r = self['attempts']
-        if r is not None:
-            return [Attempt(a, assignment=self, attempt_index=i)
-                    for i, a in enumerate(r)]
+        if r is None:
+            return None
+        if (r is not self._attempts_data or
+                len(r) != len(self._attempts)):
+            self._attempts = [Attempt(a, assignment=self, attempt_index=i)
+                              for i, a in enumerate(r)]
+            self._attempts_data = r
+        return self._attempts
 
     @property
     def attempts(self):
@@ -302,6 +373,25 @@ class StudentAssignment(ItemWrapper):
         return self.name
 
 
+def attempts_match_group(attempts, group):
+    """Return True if the attempt list (from dwr_get_attempts_info) of a
+    group assignment consists of attempts of one of the given groups.
+
+    An empty list doesn't show whose group it is, so it doesn't match.
+
+    >>> group = frozenset([('_5_1', 'Hand In Group 10')])
+    >>> attempts_match_group([{'groupName': 'Hand In Group 10'}], group)
+    True
+    >>> attempts_match_group([{'groupName': 'Hand In Group 11'}], group)
+    False
+    >>> attempts_match_group([], group)
+    False
+    """
+    names = set(name for group_id, name in group)
+    return bool(attempts) and all(a.get('groupName') in names
+                                  for a in attempts)
+
+
 def truncate_name(name, n):
     if len(name) <= n:
         return name
@@ -314,38 +404,108 @@ def truncate_name(name, n):
 class Gradebook(blackboard.Serializable):
     """Provides a view of what is accessible in the Blackboard gradebook."""
 
-    FIELDS = '_students fetch_time _assignments'.split()
+    FIELDS = '_students fetch_time _assignments attempt_counts'.split()
+
+    # Fetch the full gradebook at least this often (in seconds),
+    # even if the attempt counts of the assignments are unchanged.
+    # New assignments and changed scores are only detected by a full fetch.
+    full_refresh_interval = 30 * 60
 
     def __init__(self, session):
         assert isinstance(session, BlackboardSession)
         self.session = session
 
+    def deserialize_default(self, key):
+        if key == 'attempt_counts':
+            return None
+        return super().deserialize_default(key)
+
     @property
     def students(self):
-        return DictWrapper(Student, self._students,
-                           assignments=self.assignments)
+        """The students, wrapped once for each refresh."""
+        assignments = self.assignments
+        view = self.__dict__.get('_students_view')
+        if (view is None or view._data is not self._students or
+                view._kwargs['assignments'] is not assignments):
+            view = self._students_view = DictWrapper(
+                Student, self._students, assignments=assignments)
+        return view
 
     @property
     def assignments(self):
-        return DictWrapper(Assignment, self._assignments)
+        view = self.__dict__.get('_assignments_view')
+        if view is None or view._data is not self._assignments:
+            view = self._assignments_view = DictWrapper(
+                Assignment, self._assignments)
+        return view
+
+    def fetch_attempt_counts(self):
+        """Fetch the number of attempts of each assignment.
+
+        This is much cheaper than fetch_overview, since it only returns
+        three numbers per assignment.
+        """
+        return fetch_attempt_counts(self.session, self._assignments.keys())
+
+    def is_unchanged(self, attempt_counts, now):
+        """True if the full gradebook need not be fetched again."""
+        prev = getattr(self, 'attempt_counts', None)
+        fetch_time = getattr(self, 'fetch_time', None)
+        if prev is None or fetch_time is None:
+            return False
+        if now - fetch_time > self.full_refresh_interval:
+            return False
+        return attempt_counts == prev
+
+    def refresh(self, refresh_attempts=False, student_visible=None,
+                student_group_key=None, full=False):
+        """Fetch gradebook information from Blackboard website.
 
-    def refresh(self, refresh_attempts=False, student_visible=None):
-        """Fetch gradebook information from Blackboard website."""
+        Unless full or refresh_attempts is True, the attempt counts of the
+        assignments are fetched first, and if they are unchanged since the
+        last full refresh (and that was less than full_refresh_interval
+        seconds ago), the full gradebook is not fetched again.
+        """
         new_fetch_time = time.time()
         try:
             prev = self._students
         except AttributeError:
             prev = None
+        attempt_counts = None
+        if prev is not None and not (full or refresh_attempts):
+            try:
+                attempt_counts = self.fetch_attempt_counts()
+            except (ValueError, AssertionError) as exn:
+                logger.warning("Could not fetch attempt counts: %s", exn)
+            else:
+                if self.is_unchanged(attempt_counts, new_fetch_time):
+                    logger.info("Gradebook unchanged since %s",
+                                time.strftime('%H:%M',
+                                              time.localtime(self.fetch_time)))
+                    self.refresh_attempts(student_visible=student_visible,
+                                          student_group_key=student_group_key)
+                    return
         # The following may raise requests.ConnectionError
         overview = fetch_overview(self.session)
         self._assignments = overview.assignments
         self._students = overview.students
+        self.mark_dirty('_students')
         if prev is not None:
+            # Only attempts of changed assignments are fetched again.
             self.copy_student_data(prev)
         # No exception raised; store fetch_time
         self.fetch_time = new_fetch_time
+        if (attempt_counts is None or
+                set(attempt_counts) != set(self._assignments)):
+            try:
+                attempt_counts = self.fetch_attempt_counts()
+            except (ValueError, AssertionError) as exn:
+                logger.warning("Could not fetch attempt counts: %s", exn)
+                attempt_counts = None
+        self.attempt_counts = attempt_counts
         self.refresh_attempts(refresh_all=refresh_attempts,
-                              student_visible=student_visible)
+                              student_visible=student_visible,
+                              student_group_key=student_group_key)
 
     def copy_student_data(self, prev):
         """After updating self._students, copy over old assignment data."""
@@ -370,8 +530,66 @@ class Gradebook(blackboard.Serializable):
                 if a1['attempts'] is None:
                     a1['attempts'] = a2['attempts']
 
-    def refresh_attempts(self, attempts=None, student_visible=None, refresh_all=False):
-        """Bulk-refresh all missing assignment data."""
+    def refresh_attempts(self, attempts=None, student_visible=None,
+                         refresh_all=False, student_group_key=None):
+        """Bulk-refresh all missing assignment data.
+
+        If student_group_key is given, it must map a Student to a frozenset
+        of the (group_id, group_name) of the groups the student is in
+        (or to None if unknown). Unless refresh_all is set, the attempts of
+        a group assignment are then fetched only once for each group and
+        copied to the members for which the result names their group.
+        """
+        fetch = self.get_attempt_fetch_keys(
+            attempts=attempts, student_visible=student_visible,
+            refresh_all=refresh_all, student_group_key=student_group_key)
+        if not fetch:
+            return
+        attempt_data = self.fetch_attempt_lists(self.session, fetch)
+        self.store_attempt_lists(attempt_data)
+
+    @staticmethod
+    def fetch_attempt_lists(session, fetch):
+        """Fetch the attempt lists decided by get_attempt_fetch_keys.
+
+        Return a list of ((user_id, assignment_id), attempts).
+        The attempts fetched for one member of a group are used for the
+        other members only if they belong to the group the members are
+        expected to be in; the group memberships may be out of date, so
+        the other members are otherwise fetched individually.
+
+        This does not access the gradebook, so it may run in another thread.
+        """
+        keys = list(fetch)
+        results = []
+        recheck = []
+        for key, attempts in zip(keys, dwr_get_attempts_info(session, keys)):
+            group, members = fetch[key]
+            if (len(members) > 1 and
+                    not attempts_match_group(attempts, group)):
+                logger.debug("Attempts of %s don't match group %s; " +
+                             "fetching %d members individually",
+                             key, sorted(name for i, name in group),
+                             len(members) - 1)
+                results.append((key, attempts))
+                recheck.extend(m for m in members if m != key)
+            else:
+                results.extend((m, attempts) for m in members)
+        if recheck:
+            results.extend(zip(recheck,
+                               dwr_get_attempts_info(session, recheck)))
+        return results
+
+    def get_attempt_fetch_keys(self, attempts=None, student_visible=None,
+                               refresh_all=False, student_group_key=None):
+        """Decide which attempt lists refresh_attempts should fetch.
+
+        Return an OrderedDict mapping each (user_id, assignment_id) to
+        fetch with dwr_get_attempts_info to a pair (group, members), where
+        members is the list of (user_id, assignment_id) that receive the
+        result, and group is the expected key of student_group_key,
+        or None if the result is only for the student itself.
+        """
         attempt_keys = []
         students = self.students.values()
         if attempts is None:
@@ -388,13 +606,62 @@ class Gradebook(blackboard.Serializable):
                     a = assignment.cached_attempts or []
                     if any(attempt.id in attempt_ids for attempt in a):
                         attempt_keys.append((user.id, assignment_id))
+        fetch = collections.OrderedDict()
         if not attempt_keys:
-            return
-        logger.info("Fetching %d attempt list%s",
+            return fetch
+        # Map each DWR request to the (user_id, assignment_id) keys
+        # that receive its result.
+        groups = collections.OrderedDict()
+        for user_id, aid in attempt_keys:
+            k = (user_id, aid)
+            group = None
+            if (student_group_key is not None and not refresh_all and
+                    self.assignments[aid].group_assignment):
+                group = student_group_key(self.students[user_id])
+                if group is not None:
+                    k = (group, aid)
+            groups.setdefault(k, (group, []))[1].append((user_id, aid))
+        for group, members in groups.values():
+            fetch[members[0]] = (group, members)
+        logger.info("Fetching %d attempt list%s for %d student%s",
+                    len(fetch), '' if len(fetch) == 1 else 's',
                     len(attempt_keys), '' if len(attempt_keys) == 1 else 's')
-        attempt_data = dwr_get_attempts_info(self.session, attempt_keys)
-        for (user_id, aid), attempts in zip(attempt_keys, attempt_data):
-            self.students[user_id]['assignments'][aid]['attempts'] = attempts
+        return fetch
+
+    def store_attempt_lists(self, attempt_data):
+        """Store the result of fetch_attempt_lists."""
+        for (user_id, aid), attempts in attempt_data:
+            user = self.students[user_id]
+            user['assignments'][aid]['attempts'] = attempts
+            self.mark_dirty('_students', user_id)
+
+    def set_attempts_graded(self, scores):
+        """Record locally that attempts have been graded.
+
+        `scores` maps attempt ids to the score they were given.
+        The attempts are updated for every student that shares them,
+        without contacting Blackboard.
+        """
+        for user in self.students.values():
+            for aid, assignment in user.assignments.items():
+                attempts = assignment.cached_attempts or ()
+                if not any(a.id in scores for a in attempts):
+                    continue
+                cell = user['assignments'][aid]
+                for attempt in attempts:
+                    score = scores.get(attempt.id)
+                    if score is None:
+                        continue
+                    data = cell['attempts'][attempt.attempt_index]
+                    if assignment.group_assignment:
+                        data['groupStatus'] = None
+                        data['groupScore'] = score
+                    else:
+                        data['status'] = None
+                        data['score'] = score
+                    cell['score'] = score
+                cell['needs_grading'] = any(a.needs_grading for a in attempts)
+                self.mark_dirty('_students', user.id)
 
 
 class Rubric(object):
@@ -1,6 +1,5 @@
 import os
 import re
-import json
 import decimal
 import numbers
 import argparse
@@ -8,6 +7,7 @@ import requests
 import functools
 import blackboard
 import collections
+import concurrent.futures
 from blackboard import logger, ParserError, BadAuth, BlackboardSession
 # from groups import get_groups
 from blackboard.gradebook import (
@@ -15,8 +15,14 @@ from blackboard.gradebook import (
 )
 from blackboard.backend import (
     fetch_attempt, submit_grade, fetch_groups, fetch_rubric,
-    is_course_id_valid, NotYetSubmitted,
+    is_course_id_valid, NotYetSubmitted, download_file,
+    fetch_attempt_page, parse_attempt, upload_csv,
 )
+from blackboard.asyncsession import (
+    AsyncBlackboardSession, run_pipeline, run_until_complete,
+)
+from blackboard.fsindex import DirectoryIndex
+from blackboard.journal import UploadJournal, upload_done
 
 
 NS = {'h': 'http://www.w3.org/1999/xhtml'}
@@ -28,10 +34,31 @@ class Grading(blackboard.Serializable):
     session_class = BlackboardSession
     gradebook_class = Gradebook
 
+    # Number of concurrent requests to Blackboard
+    jobs = 4
+    # File storing the grading state. Use a name ending in .sqlite3
+    # to store it in an SQLite database, which is faster to autosave;
+    # an existing grading.json is then imported automatically.
+    state_filename = 'grading.json'
+    # Upload feedback consisting only of an accept/re-handin word as
+    # Grade Centre scores, with one CSV import per assignment,
+    # instead of posting the grading form of each attempt.
+    bulk_score_upload = False
+    # SQLite database in which to cache pages fetched from Blackboard,
+    # e.g. 'http-cache.sqlite3'. Cached pages are revalidated with
+    # conditional requests where Blackboard supports it; see
+    # BlackboardSession.http_cache_ttls for pages reused without asking.
+    http_cache_filename = None
+
     def __init__(self, session):
         self.session = session
+        if self.http_cache_filename and session.http_cache is None:
+            session.enable_http_cache(self.http_cache_filename)
         self.gradebook = type(self).gradebook_class(self.session)
         self.username = session.username
+        # Answers has_downloaded and has_feedback without a stat call
+        # per file.
+        self.fs_index = DirectoryIndex()
 
     def initialize_fields(self):
         super().initialize_fields()
@@ -45,6 +72,7 @@ class Grading(blackboard.Serializable):
         logger.info("Refresh gradebook")
         self.gradebook.refresh(
             student_visible=self.get_student_visible,
+            student_group_key=self.get_student_group_key,
             **kwargs)
         if not self.attempt_state:
             self.attempt_state = {}
@@ -64,14 +92,21 @@ class Grading(blackboard.Serializable):
         if any(k.startswith('Access the profile') for k in self.groups.keys()):
             raise Exception("fetch_groups returned bad usernames")
 
-    def get_rubric(self, attempt_rubric):
+    def get_rubric(self, attempt_rubric, fetch=True):
+        """
+        Return the Rubric for the given rubric_data entry of an attempt.
+        If fetch is False and the rubric has not been fetched,
+        raise KeyError instead of fetching it.
+        """
         if not hasattr(self, 'rubrics') or self.rubrics is None:
             self.rubrics = {}
         rubric_id = attempt_rubric['id']
         if rubric_id not in self.rubrics:
+            if not fetch:
+                raise KeyError(rubric_id)
             assoc_id = attempt_rubric['assocEntityId']
             self.rubrics[rubric_id] = fetch_rubric(
-                self.session, assoc_id, rubric)
+                self.session, assoc_id, attempt_rubric)
 
         rubric = self.rubrics[rubric_id]
         title = rubric['title']
@@ -97,12 +132,17 @@ class Grading(blackboard.Serializable):
 
         return Rubric(title=title, rows=rows)
 
-    def get_rubrics(self, attempt_id):
+    def get_attempt_rubric_data(self, attempt_id):
         if isinstance(attempt_id, Attempt):
-            attempt_id = attempt_id.id
-        attempt = self.attempt_state.get(attempt_id, {})
-        rubrics = (attempt.get('rubric_data') or dict(rubrics=()))['rubrics']
-        return [self.get_rubric(attempt_rubric) for attempt_rubric in rubrics]
+            attempt = self.get_attempt_state(attempt_id)
+        else:
+            attempt = self.attempt_state.get(attempt_id, {})
+        return (attempt.get('rubric_data') or dict(rubrics=()))['rubrics']
+
+    def get_rubrics(self, attempt_id, fetch=True):
+        rubrics = self.get_attempt_rubric_data(attempt_id)
+        return [self.get_rubric(attempt_rubric, fetch=fetch)
+                for attempt_rubric in rubrics]
 
     def deserialize_default(self, key):
         if key in ('groups', 'rubrics'):
@@ -120,6 +160,20 @@ class Grading(blackboard.Serializable):
             groups = []
         return groups
 
+    def get_student_group_key(self, student):
+        """
+        Return a key such that students with equal keys are members of
+        exactly the same Blackboard groups, or None if unknown.
+        Members of the same group share the attempts of group assignments,
+        so these are fetched only once per key.
+        The key is the frozenset of (group_id, group_name) of the groups,
+        so that the fetched attempts can be checked against the group
+        names (see Gradebook.fetch_attempt_lists).
+        """
+        groups = self.get_student_groups(student)
+        if groups:
+            return frozenset((g.id, g.name) for g in groups)
+
     def get_student_group_display(self, student):
         groups = self.get_student_groups(student)
         if self.student_group_display_regex is None:
@@ -235,8 +289,77 @@ class Grading(blackboard.Serializable):
             rows.append(cells)
         return rows
 
+    def prefetch_gradebook(self):
+        """
+        Refresh the attempt details needed by print_gradebook,
+        which only uses the stored state.
+        """
+        # Only downloaded attempts that need grading are displayed
+        # using their attempt details (see get_assignment_display).
+        attempts = [a for a in self.get_attempts(needs_grading=True)
+                    if self.get_attempt_directory(a, create=False)]
+        self.prefetch_attempts(attempts)
+
+    def prefetch_attempts(self, attempts, jobs=None):
+        """
+        Concurrently refresh the details and rubrics of those of the given
+        attempts whose stored details are missing or outdated.
+        """
+        attempts = [a for a in attempts
+                    if self.needs_refresh_attempt_files(a)]
+        if attempts:
+            logger.info("Fetch details for %d attempt%s", len(attempts),
+                        '' if len(attempts) == 1 else 's')
+            results = self.map_concurrently(
+                lambda a: fetch_attempt(self.session, a.id,
+                                        a.assignment.group_assignment),
+                attempts, jobs)
+            for attempt, result in zip(attempts, results):
+                if isinstance(result, NotYetSubmitted):
+                    logger.debug("%s not yet submitted", attempt)
+                elif isinstance(result, Exception):
+                    logger.warning("Could not fetch details for %s: %s",
+                                   attempt, result)
+                else:
+                    st = self.get_attempt_state(attempt, create=True)
+                    st.update(result)
+        if not hasattr(self, 'rubrics') or self.rubrics is None:
+            self.rubrics = {}
+        missing = collections.OrderedDict(
+            (r['id'], r) for a in attempts
+            for r in self.get_attempt_rubric_data(a)
+            if r['id'] not in self.rubrics)
+        if missing:
+            logger.info("Fetch %d rubric%s", len(missing),
+                        '' if len(missing) == 1 else 's')
+            results = self.map_concurrently(
+                lambda r: fetch_rubric(self.session, r['assocEntityId'], r),
+                missing.values(), jobs)
+            for rubric_id, result in zip(missing.keys(), results):
+                if isinstance(result, Exception):
+                    logger.warning("Could not fetch rubric %s: %s",
+                                   rubric_id, result)
+                else:
+                    self.rubrics[rubric_id] = result
+        if attempts or missing:
+            self.autosave()
+
+    def map_concurrently(self, fn, iterable, jobs=None):
+        """
+        Call fn(x) for each x in iterable in up to `jobs` worker threads
+        sharing self.session. Exceptions are returned in place of results.
+        """
+        if jobs is None:
+            jobs = self.jobs
+        with AsyncBlackboardSession(self.session, max_workers=jobs) as s:
+            return run_until_complete(
+                s.map(fn, iterable, return_exceptions=True))
+
     def print_gradebook(self):
-        """Print a representation of the gradebook state."""
+        """Print a representation of the gradebook state.
+
+        This only uses the stored state and never accesses Blackboard.
+        """
         columns = self.get_gradebook_columns()
         students = filter(self.get_student_visible,
                           self.gradebook.students.values())
@@ -331,13 +454,83 @@ class Grading(blackboard.Serializable):
                 lambda a: self.has_feedback(a) and a.needs_grading, attempts)
         return sorted(attempts)
 
-    def download_all_attempt_files(self, **kwargs):
+    def download_all_attempt_files(self, jobs=None, **kwargs):
         kwargs.setdefault('needs_grading', True)
-        kwargs.setdefault('needs_download', True)
-        for attempt in self.get_attempts(**kwargs):
-            self.download_attempt_files(attempt)
-            # print("Would download %s to %s" %
-            #       (attempt, self.get_attempt_directory_name(attempt)))
+        # Whether an attempt needs downloading is decided in the pipeline,
+        # after its details have been refreshed.
+        skip_downloaded = kwargs.pop('needs_download', True)
+        attempts = self.get_attempts(**kwargs)
+        if not attempts:
+            return
+        if jobs is None:
+            jobs = self.jobs
+        with AsyncBlackboardSession(self.session, max_workers=jobs) as s:
+            run_until_complete(self.download_attempts_pipeline(
+                s, attempts, jobs, skip_downloaded=skip_downloaded))
+
+    async def download_attempts_pipeline(self, asession, attempts, jobs,
+                                         skip_downloaded=True):
+        """Download the files of the given attempts concurrently.
+
+        Each attempt passes through the stages: fetch attempt page,
+        parse attempt page, download files, extract archives.
+        Each stage has `jobs` workers running in parallel.
+        Attempts whose details are up to date skip the fetch,
+        and files that already exist are not downloaded again.
+        """
+
+        async def fetch_page(attempt):
+            if not self.needs_refresh_attempt_files(attempt):
+                return [(attempt, None)]
+            logger.info("Fetch details for attempt %s", attempt)
+            response = await asession.call(
+                fetch_attempt_page, attempt.id,
+                attempt.assignment.group_assignment)
+            return [(attempt, response)]
+
+        async def parse_page(item):
+            attempt, response = item
+            try:
+                if response is not None:
+                    new_state = await asession.run(
+                        parse_attempt, response, attempt.id,
+                        attempt.assignment.group_assignment)
+                    self.update_attempt_state(attempt, new_state)
+                if skip_downloaded and self.has_downloaded(attempt):
+                    return
+                # Fetch missing rubrics in a worker instead of letting
+                # get_attempt_files block the event loop.
+                for r in self.get_attempt_rubric_data(attempt):
+                    if r['id'] not in self.rubrics:
+                        self.rubrics[r['id']] = await asession.fetch_rubric(
+                            r['assocEntityId'], r)
+                downloads = self.prepare_attempt_download(attempt,
+                                                          refresh=False)
+            except NotYetSubmitted:
+                logger.info('Skip downloading %s (not yet submitted)',
+                            attempt)
+                return
+            if downloads is None:
+                logger.warning('Skip downloading %s (details not fetched)',
+                               attempt)
+                return
+            return [(attempt, outfile, download_link)
+                    for outfile, download_link in downloads]
+
+        async def download(item):
+            attempt, outfile, download_link = item
+            logger.info("Download %s %s", attempt, outfile)
+            await asession.download_file(download_link, outfile)
+            return [outfile]
+
+        async def extract(outfile):
+            await asession.run(self.extract_archive, outfile)
+
+        if not hasattr(self, 'rubrics') or self.rubrics is None:
+            self.rubrics = {}
+        stages = [(fetch_page, jobs), (parse_page, jobs),
+                  (download, jobs), (extract, jobs)]
+        await run_pipeline(attempts, stages)
 
     def get_attempt_directory(self, attempt, create):
         assert isinstance(attempt, Attempt)
@@ -347,7 +540,7 @@ class Grading(blackboard.Serializable):
         except KeyError:
             pass
         else:
-            if os.path.exists(d):
+            if self.fs_index.isdir(d):
                 return d
         if not create:
             return
@@ -390,11 +583,29 @@ class Grading(blackboard.Serializable):
     def download_attempt_files(self, attempt):
         assert isinstance(attempt, Attempt)
         try:
-            files = self.get_attempt_files(attempt)
+            downloads = self.prepare_attempt_download(attempt)
         except NotYetSubmitted:
             logger.info('Skip downloading %s (not yet submitted)', attempt)
             return
+        for outfile, download_link in downloads:
+            logger.info("Download %s %s", attempt, outfile)
+            download_file(self.session, download_link, outfile)
+            self.extract_archive(outfile)
+
+    def prepare_attempt_download(self, attempt, refresh=True):
+        """
+        Create the attempt directory and store the text contents of the
+        attempt. Return a list of (filename, download link) of the files
+        that still need to be downloaded.
+
+        If refresh is False, Blackboard is not accessed, and None is
+        returned if the stored details of the attempt are incomplete.
+        """
+        files = self.get_attempt_files(attempt, refresh=refresh)
+        if files is None:
+            return None
         d = self.get_attempt_directory(attempt, create=True)
+        downloads = []
         for o in files:
             filename = o['filename']
             outfile = os.path.join(d, filename)
@@ -411,14 +622,8 @@ class Grading(blackboard.Serializable):
                 logger.info("Storing %s %s (text content)", attempt, filename)
 
             else:
-                download_link = o['download_link']
-                response = self.session.session.get(download_link, stream=True)
-                logger.info("Download %s %s", attempt, outfile)
-                with open(outfile, 'wb') as fp:
-                    for chunk in response.iter_content(chunk_size=64*1024):
-                        if chunk:
-                            fp.write(chunk)
-                self.extract_archive(outfile)
+                downloads.append((outfile, o['download_link']))
+        return downloads
 
     def extract_archive(self, filename):
         base, ext = os.path.splitext(filename)
@@ -464,8 +669,11 @@ class Grading(blackboard.Serializable):
         self.extract_tar(filename)
 
 
-    def get_attempt_files(self, attempt):
-        assert isinstance(attempt, Attempt)
+    def needs_refresh_attempt_files(self, attempt):
+        """
+        needs_refresh_attempt_files(attempt) -> True if the stored details
+        of the attempt are missing or outdated.
+        """
         keys = 'submission comments files'.split()
         st = self.get_attempt_state(attempt)
         if all(k in st for k in keys) and 'score' not in st:
@@ -474,11 +682,26 @@ class Grading(blackboard.Serializable):
         elif all(k in st for k in keys) and st['score'] != attempt.score:
             logger.debug("Refresh attempt %s since its score has changed",
                          attempt.id)
-        if (not all(k in st for k in keys) or
+        return (not all(k in st for k in keys) or
                 'score' not in st or
-                st['score'] != attempt.score):
-            self.refresh_attempt_files(attempt)
-            st = self.get_attempt_state(attempt)
+                st['score'] != attempt.score)
+
+    def get_attempt_files(self, attempt, refresh=True):
+        """
+        Return the list of files of the attempt, each a dict with
+        'filename' and either 'contents' or 'download_link'.
+
+        If refresh is False, only the stored state is used (even if it is
+        outdated), and None is returned if it is incomplete.
+        """
+        assert isinstance(attempt, Attempt)
+        st = self.get_attempt_state(attempt)
+        if refresh:
+            if self.needs_refresh_attempt_files(attempt):
+                self.refresh_attempt_files(attempt)
+                st = self.get_attempt_state(attempt)
+        elif not all(k in st for k in ('submission', 'comments', 'files')):
+            return None
         used_filenames = set(['comments.txt'])
         files = []
 
@@ -497,7 +720,11 @@ class Grading(blackboard.Serializable):
         if st.get('feedback'):
             used_filenames.remove('comments.txt')
             add_file('comments.txt', contents=st['feedback'])
-        rubrics = self.get_rubrics(attempt)
+        try:
+            rubrics = self.get_rubrics(attempt, fetch=refresh)
+        except KeyError:
+            # Rubric not fetched and refresh is False
+            return None
         if rubrics:
             add_file('rubric.txt',
                      contents='\n'.join(r.get_form_as_text() for r in rubrics))
@@ -507,12 +734,17 @@ class Grading(blackboard.Serializable):
             add_file(o['filename'], **o)
         return files
 
-    def get_attempt_state(self, attempt, create=False):
+    def get_attempt_key(self, attempt):
+        """Key of the attempt in attempt_state and the upload journal."""
         if attempt.assignment.group_assignment:
-            key = attempt.id
+            return attempt.id
         else:
-            key = attempt.id + 'I'
+            return attempt.id + 'I'
+
+    def get_attempt_state(self, attempt, create=False):
+        key = self.get_attempt_key(attempt)
         if create:
+            self.mark_dirty('attempt_state', key)
             return self.attempt_state.setdefault(key, {})
         else:
             return self.attempt_state.get(key, {})
@@ -522,6 +754,9 @@ class Grading(blackboard.Serializable):
         logger.info("Fetch details for attempt %s", attempt)
         new_state = fetch_attempt(
             self.session, attempt.id, attempt.assignment.group_assignment)
+        self.update_attempt_state(attempt, new_state)
+
+    def update_attempt_state(self, attempt, new_state):
         st = self.get_attempt_state(attempt, create=True)
         st.update(new_state)
         self.autosave()
@@ -530,24 +765,29 @@ class Grading(blackboard.Serializable):
         """
         has_downloaded(attempt) -> True if the attempt's files have been
         downloaded.
+
+        Only the stored state is used, so this never accesses Blackboard;
+        use prefetch_attempts to refresh outdated attempt details first.
         """
 
         directory = self.get_attempt_directory(attempt, create=False)
         if not directory:
             return False
         try:
-            files = self.get_attempt_files(attempt)
+            files = self.get_attempt_files(attempt, refresh=False)
         except NotYetSubmitted:
             return False
+        if files is None:
+            return False
         filenames = [os.path.join(directory, o['filename']) for o in files]
-        return all(os.path.exists(f) for f in filenames)
+        return all(self.fs_index.exists(f) for f in filenames)
 
     def has_feedback(self, attempt):
         directory = self.get_attempt_directory(attempt, create=False)
         if not directory:
             return False
         feedback_file = os.path.join(directory, 'comments.txt')
-        return os.path.exists(feedback_file)
+        return self.fs_index.exists(feedback_file)
 
     def get_feedback(self, attempt):
         directory = self.get_attempt_directory(attempt, create=False)
@@ -570,7 +810,7 @@ class Grading(blackboard.Serializable):
             self.get_annotated_filename(filename)
             for filename in filenames]
         return [filename for filename in annotated_filenames
-                if os.path.exists(filename)]
+                if self.fs_index.exists(filename)]
 
     def get_rubric_input(self, attempt):
         directory = self.get_attempt_directory(attempt, create=False)
@@ -607,14 +847,23 @@ class Grading(blackboard.Serializable):
     def get_attempt_score(self, attempt, comments):
         return self.get_feedback_score(comments)
 
-    def upload_all_feedback(self, dry_run=False):
+    def upload_all_feedback(self, dry_run=False, wait=True):
         return self.upload_attempts(self.get_attempts(needs_upload=True),
-                                    dry_run=dry_run)
+                                    dry_run=dry_run, wait=wait)
 
     def upload_attempt(self, attempt, dry_run=False):
         return self.upload_attempts([attempt], dry_run=dry_run)
 
-    def upload_attempts(self, attempts, dry_run):
+    def upload_attempts(self, attempts, dry_run, jobs=None, wait=True):
+        """
+        Upload the feedback of the given attempts, using up to `jobs`
+        concurrent uploads (default: self.jobs).
+        Return the list of attempts that were uploaded successfully.
+
+        The uploaded scores are stored in the gradebook right away, and
+        checked against Blackboard in the background. If wait is False,
+        call finish_upload_verification to wait for the check.
+        """
         uploads = []
         for attempt in attempts:
             feedback = self.get_feedback(attempt)
@@ -641,27 +890,272 @@ class Grading(blackboard.Serializable):
             else:
                 uploads.append(
                     (attempt, score, feedback, attachments, rubrics))
+        # A dry run must not create or change the journal
+        journal = None if dry_run else self.get_upload_journal()
+        try:
+            uploaded = self.upload_validated(uploads, dry_run, jobs, journal)
+        finally:
+            if journal is not None:
+                journal.close()
+        if wait:
+            self.finish_upload_verification()
+        return uploaded
+
+    def get_upload_journal(self):
+        """
+        Return the UploadJournal stored next to the grading state file,
+        or None if the grading state is not stored in a file.
+        """
+        filename = getattr(self, 'filename', None)
+        if filename is None:
+            return None
+        return UploadJournal(os.path.splitext(filename)[0] + '.uploads.jsonl')
+
+    def reconcile_uploads(self, uploads, journal):
+        """
+        Skip the uploads that the journal shows were already posted,
+        if Blackboard shows them as graded (see upload_done).
+        Attempts in the journal are checked against Blackboard with a
+        single attempts info batch, so an upload that may have been posted
+        before a crash is not posted twice, and an upload is posted again
+        if its grade has been cleared in Blackboard since.
+        """
+        known = [u[0] for u in uploads
+                 if journal.get_state(self.get_attempt_key(u[0]))]
+        if known:
+            logger.info("Checking %d previous upload%s", len(known),
+                        '' if len(known) == 1 else 's')
+            self.gradebook.refresh_attempts(
+                attempts=known, student_group_key=self.get_student_group_key)
+            for attempt in known:
+                key = self.get_attempt_key(attempt)
+                if (journal.get_state(key) != 'verified' and
+                        self.is_upload_visible(attempt)):
+                    journal.record(key, 'verified')
+            self.autosave()
+        result = []
+        for u in uploads:
+            attempt = u[0]
+            record = journal.get_record(self.get_attempt_key(attempt))
+            done = upload_done(record, self.is_upload_visible(attempt),
+                               attempt.assignment.score)
+            if done == 'graded':
+                print("Skipping %s %s (already uploaded)" %
+                      (attempt.assignment, attempt))
+            elif done == 'csv':
+                print("Skipping %s %s (score uploaded to Grade Centre)" %
+                      (attempt.assignment, attempt))
+            else:
+                if record is not None and record['state'] != 'intent':
+                    print("Uploading %s %s again (uploaded before, but " %
+                          (attempt.assignment, attempt) +
+                          "not shown as graded in Blackboard)")
+                result.append(u)
+        return result
+
+    def is_upload_visible(self, attempt):
+        """True if the gradebook shows the attempt as graded."""
+        for a in attempt.assignment.cached_attempts or ():
+            if a.id == attempt.id:
+                return not a.needs_grading
+        return False
+
+    def upload_validated(self, uploads, dry_run, jobs, journal):
+        if journal is not None:
+            uploads = self.reconcile_uploads(uploads, journal)
+        bulk = []
+        if self.bulk_score_upload:
+            bulk = [u for u in uploads if self.is_score_only_upload(*u)]
+            uploads = [u for u in uploads
+                       if not any(u is b for b in bulk)]
         if dry_run:
+            for attempt, score, feedback, attachments, rubrics in bulk:
+                print("%s %s:" % (attempt.assignment, attempt,))
+                print("score: %s (Grade Centre CSV)" % (score,))
             for attempt, score, feedback, attachments, rubrics in uploads:
                 print("%s %s:" % (attempt.assignment, attempt,))
                 print("score: %s, feedback: %s words, %s attachment(s)" %
                       (score, len(feedback.split()), len(attachments)))
                 print("rubrics: %s" % (rubrics,))
-        else:
-            for attempt, score, feedback, attachments, rubrics in uploads:
-                submit_grade(self.session, attempt.id,
-                             attempt.assignment.group_assignment,
-                             score, feedback, attachments, rubrics)
-            self.gradebook.refresh_attempts(
-                attempts=[attempt for attempt, _s, _f, _a, _r in uploads])
+            return []
+        if not uploads and not bulk:
+            return []
+        uploaded = []
+        if bulk:
+            uploaded += self.upload_scores_csv(bulk, journal)
+
+        def upload(u):
+            attempt, score, feedback, attachments, rubrics = u
+            key = self.get_attempt_key(attempt)
+            if journal is not None:
+                journal.record(key, 'intent', score=score)
+            submit_grade(self.session, attempt.id,
+                         attempt.assignment.group_assignment,
+                         score, feedback, attachments, rubrics)
+            if journal is not None:
+                journal.record(key, 'posted')
+
+        results = self.map_concurrently(upload, uploads, jobs)
+        for (attempt, score, *rest), result in zip(uploads, results):
+            if isinstance(result, Exception):
+                logger.debug("Upload of %s failed", attempt, exc_info=result)
+                print("Upload failed for %s %s: %s" %
+                      (attempt.assignment, attempt, result))
+            else:
+                print("Uploaded %s %s (score: %s)" %
+                      (attempt.assignment, attempt, score))
+                uploaded.append(attempt)
+        n = len(uploads) + len(bulk)
+        if len(uploaded) < n:
+            print("%d of %d uploads failed" % (n - len(uploaded), n))
+        if uploaded:
+            # submit_grade has checked Blackboard's success message,
+            # so show the new scores without refreshing the gradebook.
+            # A CSV import only sets the Grade Centre score and leaves
+            # the attempt ungraded, so those attempts are left as they are.
+            graded = set(a.id for a in uploaded)
+            self.gradebook.set_attempts_graded(
+                {u[0].id: u[1] for u in uploads if u[0].id in graded})
             self.autosave()
+            self.start_upload_verification(uploaded)
+        return uploaded
+
+    def start_upload_verification(self, attempts):
+        """
+        Start fetching the attempt lists of the uploaded attempts in a
+        background thread. The result is stored by
+        finish_upload_verification.
+        """
+        self.finish_upload_verification()
+        fetch = self.gradebook.get_attempt_fetch_keys(
+            attempts=attempts, student_group_key=self.get_student_group_key)
+        if not fetch:
+            return
+        executor = concurrent.futures.ThreadPoolExecutor(1)
+        future = executor.submit(
+            self.gradebook.fetch_attempt_lists, self.session, fetch)
+        executor.shutdown(wait=False)
+        self._upload_verification = (future, attempts)
+
+    def finish_upload_verification(self):
+        """
+        Wait for the check started by start_upload_verification, store the
+        attempt lists from Blackboard, and report uploads that are not
+        shown as graded.
+        """
+        pending = self.__dict__.pop('_upload_verification', None)
+        if pending is None:
+            return
+        future, attempts = pending
+        try:
+            attempt_data = future.result()
+        except Exception as exn:
+            logger.warning("Could not check the uploads: %s", exn)
+            return
+        self.gradebook.store_attempt_lists(attempt_data)
+        journal = self.get_upload_journal()
+        try:
+            for attempt in attempts:
+                key = self.get_attempt_key(attempt)
+                if self.is_upload_visible(attempt):
+                    if journal is not None:
+                        journal.record(key, 'verified')
+                elif (journal is None or
+                      (journal.get_record(key) or {}).get('method') != 'csv'):
+                    print("%s %s is not shown as graded after the upload" %
+                          (attempt.assignment, attempt))
+        finally:
+            if journal is not None:
+                journal.close()
+        self.autosave()
+
+    def is_score_only_upload(self, attempt, score, feedback, attachments,
+                             rubrics):
+        """
+        True if the upload can be done with bulk_score_upload, that is,
+        if the feedback is just the accept/re-handin word.
+        """
+        if attachments or rubrics:
+            return False
+        pattern = r'(?:%s|%s)[.!]?' % (self.rehandin_regex, self.accept_regex)
+        return re.fullmatch(pattern, feedback.strip(), re.I) is not None
+
+    def get_attempt_usernames(self, attempts):
+        """
+        Return a dict mapping the id of each of the given attempts
+        to the usernames of the students that share the attempt.
+        """
+        usernames = {a.id: [] for a in attempts}
+        assignment_ids = set(a.assignment.id for a in attempts)
+        for student in self.gradebook.students.values():
+            for assignment_id in assignment_ids:
+                try:
+                    a = student.assignments[assignment_id].cached_attempts
+                except KeyError:
+                    continue
+                for attempt in a or ():
+                    if attempt.id in usernames:
+                        usernames[attempt.id].append(student.username)
+        return usernames
+
+    def upload_scores_csv(self, uploads, journal):
+        """
+        Upload the scores of the given score-only uploads to the
+        Grade Centre with one CSV import for each assignment.
+        Return the list of attempts that were uploaded.
+
+        The imports are run one after another, since Blackboard keeps
+        the state of the upload wizard in the server session.
+        """
+        columns = collections.OrderedDict()
+        for attempt, score, feedback, attachments, rubrics in uploads:
+            columns.setdefault(attempt.assignment.id, []).append(
+                (attempt, score))
+        usernames = self.get_attempt_usernames([u[0] for u in uploads])
+
+        def upload(assignment_id, attempt_scores):
+            assignment = self.gradebook.assignments[assignment_id]
+            # If a student has several attempts, the last one counts
+            scores = collections.OrderedDict()
+            for attempt, score in sorted(attempt_scores,
+                                         key=lambda x: x[0].attempt_index):
+                for username in usernames[attempt.id]:
+                    scores[username] = '%g' % score
+                if journal is not None:
+                    journal.record(self.get_attempt_key(attempt), 'intent',
+                                   score=score, method='csv')
+            upload_csv(self.session,
+                       ['Username', '%s|%s' % (assignment.name,
+                                               assignment_id)],
+                       [list(row) for row in scores.items()])
+            if journal is not None:
+                for attempt, score in attempt_scores:
+                    journal.record(self.get_attempt_key(attempt), 'posted',
+                                   score=score, method='csv')
+
+        uploaded = []
+        for assignment_id, attempt_scores in columns.items():
+            try:
+                upload(assignment_id, attempt_scores)
+            except Exception as exn:
+                logger.debug("CSV upload failed", exc_info=True)
+                for attempt, score in attempt_scores:
+                    print("Upload failed for %s %s: %s" %
+                          (attempt.assignment, attempt, exn))
+                continue
+            for attempt, score in attempt_scores:
+                print("Uploaded %s %s (score: %s, Grade Centre CSV)" %
+                      (attempt.assignment, attempt, score))
+                uploaded.append(attempt)
+        return uploaded
 
     def main(self, args, session, grading):
         if args.refresh_groups:
             self.refresh_groups()
         if args.refresh:
             try:
-                self.refresh(refresh_attempts=args.refresh_attempts)
+                self.refresh(refresh_attempts=args.refresh_attempts,
+                             full=args.full_refresh)
             except requests.ConnectionError:
                 print("Connection failed; continuing in offline mode (-n)")
                 args.refresh = False
@@ -671,6 +1165,10 @@ class Grading(blackboard.Serializable):
             group, assignment, attempt_index = args.download_attempt
             self.download_attempt_files(
                 self.get_attempt(group, assignment, attempt_index))
+        if args.jobs is not None:
+            self.jobs = args.jobs
+        if args.bulk_scores:
+            self.bulk_score_upload = True
         if args.download >= 3:
             self.download_all_attempt_files(
                 visible=None, needs_grading=None)
@@ -683,12 +1181,12 @@ class Grading(blackboard.Serializable):
         if args.upload_check:
             self.upload_all_feedback(dry_run=True)
         if args.upload:
-            self.upload_all_feedback(dry_run=False)
-            if args.refresh:
-                # Refresh after upload to show that feedback
-                # has been uploaded
-                self.refresh()
+            # The uploads are checked while the gradebook is printed.
+            self.upload_all_feedback(dry_run=False, wait=False)
+        if args.refresh:
+            self.prefetch_gradebook()
         self.print_gradebook()
+        self.finish_upload_verification()
         if args.save is not None:
             with open(args.save, 'w') as fp:
                 self.dump_gradebook(fp)
@@ -719,17 +1217,27 @@ class Grading(blackboard.Serializable):
                     print("Student attempts not loaded")
             print('')
 
-    @staticmethod
-    def get_setting(key):
+    @classmethod
+    def get_setting(cls, key):
+        """
+        Return the value of key in the saved grading state
+        (JSON or SQLite, see state_filename), or None.
+        May be called before the Grading object is created.
+        """
+        # read_state only needs the store, not a session
+        state = cls.__new__(cls)
         try:
-            with open('grading.json') as fp:
-                o = json.load(fp)
+            o = state.read_state(cls.state_filename)
             try:
                 return o[key]
             except KeyError:
                 return o['payload'][key]
         except Exception:
             pass
+        finally:
+            store = getattr(state, '_store', None)
+            if store is not None:
+                store.close()
 
     @classmethod
     def get_argument_parser(cls):
@@ -749,16 +1257,38 @@ class Grading(blackboard.Serializable):
                                  'attempt index 0', type=attempt_type)
         parser.add_argument('--download', '-d', action='count', default=0,
                             help='Download handins that need grading')
+        parser.add_argument('--jobs', '-j', type=int,
+                            help='Number of concurrent requests to ' +
+                                 'Blackboard (default: %d)' % cls.jobs)
+        parser.add_argument('--timeout', type=float, metavar='SECONDS',
+                            help='Give up on a request when Blackboard ' +
+                                 'sends nothing for this long (default: ' +
+                                 '%d)' % cls.session_class.read_timeout)
+        parser.add_argument('--retries', type=int,
+                            help='Number of retries of failed GET ' +
+                                 'requests (default: %d)' %
+                                 cls.session_class.retries)
+        parser.add_argument('--pool-size', type=int,
+                            help='Number of connections to keep open ' +
+                                 '(default: the larger of %d and --jobs)' %
+                                 cls.session_class.pool_size)
         parser.add_argument('--upload', '-u', action='store_true',
                             help='Upload handins that have been graded')
         parser.add_argument('--upload-check', '-U', action='store_true',
                             help='Display what would be uploaded with -u')
+        parser.add_argument('--bulk-scores', action='store_true',
+                            help='With -u, upload feedback that is only ' +
+                                 'a score as one Grade Centre CSV per ' +
+                                 'assignment')
         parser.add_argument('--no-refresh', '-n', action='store_false',
                             dest='refresh', help='Run in offline mode')
         parser.add_argument('--refresh-groups', '-g', action='store_true',
                             help='Refresh list of student groups')
         parser.add_argument('--refresh-attempts', '-a', action='store_true',
                             help='Refresh list of student attempts')
+        parser.add_argument('--full-refresh', action='store_true',
+                            help='Fetch the full gradebook even if no ' +
+                                 'attempts have been added')
         parser.add_argument('--save', '-o',
                             help='Output TSV file with gradebook info')
 
@@ -829,10 +1359,17 @@ class Grading(blackboard.Serializable):
                          ' and '.join(not_implemented))
 
         session = cls.session_class('cookies.txt', username, course)
+        session.configure_transport(
+            pool_size=args.pool_size or max(session.pool_size,
+                                            args.jobs or cls.jobs),
+            timeout=args.timeout, retries=args.retries)
+        # Pages fetched more than once during this run are only fetched
+        # again if something was posted in between.
+        session.enable_get_memo()
         grading = cls(session)
         grading.override_get_password(args)
         try:
-            grading.load('grading.json')
+            grading.load(cls.state_filename)
             grading.main(args, session, grading)
         except ParserError as exn:
             logger.error("Parsing error")
@@ -844,7 +1381,7 @@ class Grading(blackboard.Serializable):
         except Exception:
             logger.exception("Uncaught exception")
         else:
-            grading.save('grading.json')
+            grading.save(cls.state_filename)
         session.save_cookies()
 
     @classmethod
@@ -852,7 +1389,7 @@ class Grading(blackboard.Serializable):
         course = cls.get_course(None)
         username = cls.get_username(None)
         cookiejar = 'cookies.txt'
-        dbpath = 'grading.json'
+        dbpath = cls.state_filename
         session = cls.session_class(cookiejar, username, course)
         grading = cls(session)
         grading.load(dbpath)
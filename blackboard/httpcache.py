@@ -0,0 +1,152 @@
+import re
+import json
+import time
+import zlib
+import sqlite3
+import threading
+import collections
+
+import requests
+import requests.structures
+import requests.utils
+
+
+# Response headers kept in the cache
+STORED_HEADERS = ('Content-Type', 'ETag', 'Last-Modified')
+
+
+class CacheEntry(collections.namedtuple(
+        'CacheEntry', 'url status headers content stored ttl')):
+    def is_fresh(self):
+        return self.ttl > 0 and time.time() - self.stored < self.ttl
+
+    def conditional_headers(self):
+        """Request headers to revalidate the entry, if possible."""
+        headers = {}
+        if 'ETag' in self.headers:
+            headers['If-None-Match'] = self.headers['ETag']
+        if 'Last-Modified' in self.headers:
+            headers['If-Modified-Since'] = self.headers['Last-Modified']
+        return headers
+
+    def to_response(self):
+        response = requests.Response()
+        response.status_code = self.status
+        response.reason = 'OK'
+        response.url = self.url
+        response.headers = requests.structures.CaseInsensitiveDict(
+            self.headers)
+        response.encoding = requests.utils.get_encoding_from_headers(
+            response.headers)
+        response._content = self.content
+        response._content_consumed = True
+        response.from_cache = True
+        return response
+
+
+class HttpCache:
+    """
+    On-disk cache of GET responses, stored in an SQLite database with
+    zlib-compressed bodies. When the total size of the stored bodies
+    exceeds max_size bytes, the least recently used entries are evicted.
+
+    A response is stored if it has an ETag or Last-Modified header,
+    in which case it is revalidated with a conditional request before
+    it is used, or if its URL matches one of the `ttls` patterns, in
+    which case it is used without revalidation for the given number of
+    seconds. The Cache-Control headers sent by Blackboard are ignored,
+    since they forbid caching of every page.
+
+    >>> cache = HttpCache(':memory:', ttls=[(r'\\.js$', 60)])
+    >>> response = requests.Response()
+    >>> response.status_code, response.url = 200, 'https://x/engine.js'
+    >>> response._content = b'var dwr = {};'
+    >>> cache.store('engine', response)
+    True
+    >>> entry = cache.lookup('engine')
+    >>> entry.is_fresh(), entry.to_response().text
+    (True, 'var dwr = {};')
+    """
+
+    def __init__(self, filename, ttls=(), max_size=100 * 2 ** 20):
+        self.filename = filename
+        self.ttls = [(re.compile(p), t) for p, t in ttls]
+        self.max_size = max_size
+        self._lock = threading.Lock()
+        # The session may be used from several threads
+        self._db = sqlite3.connect(filename, check_same_thread=False)
+        with self._db:
+            self._db.execute(
+                'CREATE TABLE IF NOT EXISTS response (' +
+                'key TEXT PRIMARY KEY, url TEXT NOT NULL, ' +
+                'status INTEGER NOT NULL, headers TEXT NOT NULL, ' +
+                'content BLOB NOT NULL, size INTEGER NOT NULL, ' +
+                'stored REAL NOT NULL, accessed REAL NOT NULL)')
+        self._size = self._db.execute(
+            'SELECT COALESCE(SUM(size), 0) FROM response').fetchone()[0]
+
+    def close(self):
+        with self._lock:
+            self._db.close()
+
+    def get_ttl(self, url):
+        for pattern, ttl in self.ttls:
+            if pattern.search(url):
+                return ttl
+        return 0
+
+    def lookup(self, key):
+        with self._lock:
+            row = self._db.execute(
+                'SELECT url, status, headers, content, stored ' +
+                'FROM response WHERE key = ?', (key,)).fetchone()
+            if row is None:
+                return None
+            with self._db:
+                self._db.execute(
+                    'UPDATE response SET accessed = ? WHERE key = ?',
+                    (time.time(), key))
+        url, status, headers, content, stored = row
+        return CacheEntry(url, status, json.loads(headers),
+                          zlib.decompress(content), stored,
+                          self.get_ttl(url))
+
+    def touch(self, key):
+        """Record that the entry has just been revalidated."""
+        with self._lock, self._db:
+            self._db.execute(
+                'UPDATE response SET stored = ? WHERE key = ?',
+                (time.time(), key))
+
+    def store(self, key, response):
+        """Store the response if it is cacheable. Return True if stored."""
+        headers = {k: response.headers[k] for k in STORED_HEADERS
+                   if k in response.headers}
+        if ('ETag' not in headers and 'Last-Modified' not in headers and
+                not self.get_ttl(response.url)):
+            return False
+        content = zlib.compress(response.content)
+        now = time.time()
+        with self._lock, self._db:
+            old = self._db.execute('SELECT size FROM response WHERE key = ?',
+                                   (key,)).fetchone()
+            if old is not None:
+                self._size -= old[0]
+            self._db.execute(
+                'INSERT OR REPLACE INTO response VALUES (?,?,?,?,?,?,?,?)',
+                (key, response.url, response.status_code,
+                 json.dumps(headers), content, len(content), now, now))
+            self._size += len(content)
+            if self._size > self.max_size:
+                self._evict()
+        return True
+
+    def _evict(self):
+        rows = self._db.execute(
+            'SELECT key, size FROM response ORDER BY accessed').fetchall()
+        target = self.max_size * 0.9
+        for key, size in rows:
+            if self._size <= target:
+                break
+            self._db.execute('DELETE FROM response WHERE key = ?', (key,))
+            self._size -= size
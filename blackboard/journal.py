@@ -0,0 +1,148 @@
+import os
+import json
+import time
+import threading
+
+
+class UploadJournal:
+    """
+    Append-only journal of feedback uploads, stored as one JSON object
+    per line, so that an interrupted upload can be resumed without
+    posting the same feedback twice.
+
+    Each upload goes through the states 'intent' (about to be posted),
+    'posted' (Blackboard accepted the feedback) and 'verified' (the
+    attempt is shown as graded in the gradebook).
+    Every record is flushed to disk before the upload continues.
+
+    >>> import tempfile
+    >>> filename = os.path.join(tempfile.mkdtemp(), 'uploads.jsonl')
+    >>> journal = UploadJournal(filename)
+    >>> journal.record('_1_1', 'intent', score=1)
+    >>> journal.record('_1_1', 'posted')
+    >>> journal.close()
+    >>> UploadJournal(filename).get_state('_1_1')
+    'posted'
+
+    A partial last line left by a crash is removed:
+
+    >>> with open(filename, 'a') as fp:
+    ...     n = fp.write('{"attempt": "_2_1", "sta')
+    >>> journal = UploadJournal(filename)
+    >>> journal.record('_3_1', 'intent', score=1)
+    >>> journal.close()
+    >>> journal = UploadJournal(filename)
+    >>> [journal.get_state(k) for k in ('_1_1', '_2_1', '_3_1')]
+    ['posted', None, 'intent']
+    >>> journal.close()
+    """
+
+    STATES = ('intent', 'posted', 'verified')
+
+    # Rewrite the journal when it has this many superfluous records
+    compact_threshold = 1000
+
+    def __init__(self, filename):
+        self.filename = filename
+        self._lock = threading.Lock()
+        # Map attempt key to its latest record
+        self._records = {}
+        n = 0
+        # Offset of the end of the last complete line
+        end = 0
+        torn = False
+        try:
+            with open(filename, 'rb') as fp:
+                for line in fp:
+                    try:
+                        o = json.loads(line.decode('utf-8'))
+                    except ValueError:
+                        # Partially written last line
+                        torn = True
+                        continue
+                    if not line.endswith(b'\n'):
+                        # Complete record, but the newline is missing
+                        torn = True
+                    end = fp.tell()
+                    self._records[o['attempt']] = o
+                    n += 1
+        except FileNotFoundError:
+            pass
+        if torn:
+            # Remove the partial line, so that the next record does not
+            # get appended to it.
+            with open(filename, 'r+b') as fp:
+                fp.truncate(end)
+                if end:
+                    fp.seek(end - 1)
+                    if fp.read(1) != b'\n':
+                        fp.write(b'\n')
+        if n - len(self._records) > self.compact_threshold:
+            self._compact()
+        self._fp = open(filename, 'a')
+
+    def close(self):
+        self._fp.close()
+
+    def _compact(self):
+        tmp = self.filename + '.tmp'
+        with open(tmp, 'w') as fp:
+            for o in self._records.values():
+                fp.write(json.dumps(o) + '\n')
+            fp.flush()
+            os.fsync(fp.fileno())
+        os.replace(tmp, self.filename)
+
+    def get_record(self, key):
+        """Return the latest record (a dict) for key, or None."""
+        return self._records.get(key)
+
+    def get_state(self, key):
+        """Return the latest state recorded for key, or None."""
+        o = self._records.get(key)
+        return o and o['state']
+
+    def record(self, key, state, **data):
+        """Append a record of the new state of the upload of key."""
+        if state not in self.STATES:
+            raise ValueError("Unknown state %r" % (state,))
+        o = dict(attempt=key, state=state, time=time.time(), **data)
+        with self._lock:
+            self._fp.write(json.dumps(o) + '\n')
+            self._fp.flush()
+            os.fsync(self._fp.fileno())
+            self._records[key] = o
+
+
+def upload_done(record, graded, cell_score=None):
+    """
+    Decide whether the upload of an attempt, whose latest journal record
+    is `record` (or None), has taken effect in Blackboard.
+    `graded` tells if Blackboard shows the attempt as graded, and
+    `cell_score` is the score shown in the Grade Centre.
+
+    Return 'graded' if the attempt is graded, 'csv' if the score of a
+    Grade Centre CSV upload is shown, and None if the feedback must be
+    uploaded (again). An upload that crashed after 'intent' may or may not
+    have been posted, so it is also checked against Blackboard.
+
+    >>> print(upload_done({'state': 'intent', 'score': 1}, graded=True))
+    graded
+    >>> print(upload_done({'state': 'intent', 'score': 1}, graded=False))
+    None
+    >>> record = {'state': 'posted', 'score': 1, 'method': 'csv'}
+    >>> print(upload_done(record, graded=False, cell_score=1.0))
+    csv
+    >>> print(upload_done(record, graded=False, cell_score=0.0))
+    None
+    >>> print(upload_done(None, graded=True))
+    None
+    """
+    if record is None:
+        return None
+    if graded:
+        return 'graded'
+    if (record.get('method') == 'csv' and record.get('score') is not None and
+            cell_score == record['score']):
+        return 'csv'
+    return None
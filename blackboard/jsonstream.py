@@ -0,0 +1,98 @@
+import re
+import json
+
+
+_WHITESPACE = re.compile(r'[ \t\n\r]*')
+
+
+class IncrementalJsonReader:
+    """
+    Read a JSON document piece by piece with json.JSONDecoder.raw_decode,
+    so that the items of a large array can be processed one at a time
+    instead of decoding the entire document into Python objects at once.
+
+    members() and items() iterate over the object or array at the current
+    position. After each key (or before each item), the caller reads the
+    value with value(), members() or items(); a value that is not read is
+    skipped.
+
+    >>> r = IncrementalJsonReader('{"a": [1, [2]], "b": {"c": 3}, "d": 4}')
+    >>> for key in r.members():
+    ...     if key == 'a':
+    ...         print(key, list(r.items()))
+    ...     elif key == 'b':
+    ...         print(key, r.value())
+    a [1, [2]]
+    b {'c': 3}
+    >>> r.at_end()
+    True
+    """
+
+    def __init__(self, text):
+        self.text = text
+        self.pos = 0
+        self._decoder = json.JSONDecoder()
+
+    def _skip_whitespace(self):
+        self.pos = _WHITESPACE.match(self.text, self.pos).end()
+
+    def _next_char(self):
+        self._skip_whitespace()
+        try:
+            c = self.text[self.pos]
+        except IndexError:
+            raise ValueError("Unexpected end of JSON at %d" % self.pos)
+        self.pos += 1
+        return c
+
+    def _expect(self, c):
+        if self._next_char() != c:
+            raise ValueError("Expected %r at %d" % (c, self.pos - 1))
+
+    def at_end(self):
+        self._skip_whitespace()
+        return self.pos == len(self.text)
+
+    def value(self):
+        """Decode the value at the current position."""
+        self._skip_whitespace()
+        v, self.pos = self._decoder.raw_decode(self.text, self.pos)
+        return v
+
+    def members(self):
+        """Iterate over the keys of the object at the current position."""
+        self._expect('{')
+        self._skip_whitespace()
+        if self.text.startswith('}', self.pos):
+            self.pos += 1
+            return
+        while True:
+            key = self.value()
+            if not isinstance(key, str):
+                raise ValueError("Expected object key at %d" % self.pos)
+            self._expect(':')
+            start = self.pos
+            yield key
+            if self.pos == start:
+                self.value()
+            c = self._next_char()
+            if c == '}':
+                return
+            if c != ',':
+                raise ValueError("Expected ',' or '}' at %d" % (self.pos - 1))
+
+    def items(self):
+        """Iterate over the decoded items of the array at the current
+        position."""
+        self._expect('[')
+        self._skip_whitespace()
+        if self.text.startswith(']', self.pos):
+            self.pos += 1
+            return
+        while True:
+            yield self.value()
+            c = self._next_char()
+            if c == ']':
+                return
+            if c != ',':
+                raise ValueError("Expected ',' or ']' at %d" % (self.pos - 1))
@@ -0,0 +1,176 @@
+import io
+import os
+import uuid
+
+
+def _quote_param(value):
+    # Same escaping as browsers (and urllib3) use in
+    # Content-Disposition parameters.
+    return (value.replace('"', '%22').replace('\r', '%0D')
+            .replace('\n', '%0A'))
+
+
+def _to_bytes(value):
+    if isinstance(value, bytes):
+        return value
+    return str(value).encode('utf-8')
+
+
+class MultipartEncoder(io.RawIOBase):
+    """
+    A multipart/form-data request body that is read in chunks,
+    so that large files are streamed instead of loaded into memory.
+
+    `fields` is a list of (name, value) as in the `data` argument of
+    requests.post, and `files` is a list of (name, file) as in the
+    `files` argument, where file is either a file object or a tuple
+    (filename, source) or (filename, source, content_type).
+    The source can be bytes, str, a binary file object, or an os.PathLike
+    (e.g. pathlib.Path) naming a file, which is opened when it is read.
+
+    The length of the body is known in advance, so requests sends it
+    with a Content-Length header.
+
+    >>> body = MultipartEncoder([('grade', 1)], [('f', ('a.txt', b'hi'))],
+    ...                         boundary='xyz')
+    >>> len(body)
+    140
+    >>> print(body.read().decode().replace('\\r\\n', '|'))
+    --xyz|Content-Disposition: form-data; name="grade"||1|--xyz|Content-Disposition: form-data; name="f"; filename="a.txt"||hi|--xyz--|
+    """
+
+    blocksize = 64 * 1024
+
+    def __init__(self, fields, files=(), boundary=None):
+        super().__init__()
+        self.boundary = boundary or uuid.uuid4().hex
+        self.content_type = 'multipart/form-data; boundary=%s' % self.boundary
+        # Each part is either bytes or a (source, size) pair
+        self._parts = []
+        for name, values in fields:
+            if name is None:
+                continue
+            if isinstance(values, (str, bytes)) or not hasattr(values,
+                                                               '__iter__'):
+                values = [values]
+            for value in values:
+                if value is not None:
+                    self._add_part(name, None, None, _to_bytes(value))
+        for name, file in files:
+            if isinstance(file, (tuple, list)):
+                filename, source, *rest = file
+                content_type = rest[0] if rest else None
+            else:
+                source = file
+                filename = os.path.basename(
+                    getattr(file, 'name', None) or name)
+                content_type = None
+            self._add_part(name, filename, content_type, source)
+        self._parts.append(('--%s--\r\n' % self.boundary).encode())
+        self._length = sum(
+            len(p) if isinstance(p, bytes) else p[1] for p in self._parts)
+        self._reset()
+
+    def _add_part(self, name, filename, content_type, source):
+        header = '--%s\r\nContent-Disposition: form-data; name="%s"' % (
+            self.boundary, _quote_param(name))
+        if filename is not None:
+            header += '; filename="%s"' % _quote_param(filename)
+        if content_type:
+            header += '\r\nContent-Type: %s' % content_type
+        header += '\r\n\r\n'
+        self._parts.append(header.encode('utf-8'))
+        if isinstance(source, (str, bytes)):
+            self._parts.append(_to_bytes(source))
+        elif isinstance(source, os.PathLike):
+            self._parts.append((source, os.stat(source).st_size))
+        else:
+            position = source.tell()
+            size = source.seek(0, io.SEEK_END) - position
+            source.seek(position)
+            if isinstance(source, io.TextIOBase):
+                # The encoded length is unknown; read it all
+                self._parts.append(_to_bytes(source.read()))
+                source.seek(position)
+            else:
+                self._parts.append(((source, position), size))
+        self._parts.append(b'\r\n')
+
+    def _chunks(self):
+        for part in self._parts:
+            if isinstance(part, bytes):
+                yield part
+                continue
+            source, size = part
+            if isinstance(source, os.PathLike):
+                fp = open(source, 'rb')
+            else:
+                fp, position = source
+                fp.seek(position)
+            try:
+                while size > 0:
+                    chunk = fp.read(min(size, self.blocksize))
+                    if not chunk:
+                        raise ValueError("%s is shorter than expected" %
+                                         (getattr(fp, 'name', fp),))
+                    size -= len(chunk)
+                    yield chunk
+            finally:
+                if isinstance(source, os.PathLike):
+                    fp.close()
+
+    def _reset(self):
+        self._iter = self._chunks()
+        self._buffer = b''
+        self._position = 0
+
+    def __len__(self):
+        return self._length
+
+    def readable(self):
+        return True
+
+    def seekable(self):
+        return True
+
+    def tell(self):
+        return self._position
+
+    def seek(self, offset, whence=io.SEEK_SET):
+        # Only rewinding (e.g. to send the body again) and
+        # finding the length are supported.
+        if whence == io.SEEK_END and offset == 0:
+            while self.read(self.blocksize):
+                pass
+        elif offset == 0 and whence == io.SEEK_SET:
+            self._iter.close()
+            self._reset()
+        elif not (offset == 0 and whence == io.SEEK_CUR):
+            raise io.UnsupportedOperation("can only seek to start or end")
+        return self._position
+
+    def readinto(self, b):
+        data = self.read(len(b))
+        b[:len(data)] = data
+        return len(data)
+
+    def read(self, size=-1):
+        if size is None or size < 0:
+            size = self._length - self._position
+        chunks = [self._buffer]
+        n = len(self._buffer)
+        while n < size:
+            chunk = next(self._iter, None)
+            if chunk is None:
+                break
+            chunks.append(chunk)
+            n += len(chunk)
+        data = b''.join(chunks)
+        self._buffer = data[size:]
+        data = data[:size]
+        self._position += len(data)
+        return data
+
+    def close(self):
+        self._iter.close()
+        super().close()
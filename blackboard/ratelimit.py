@@ -0,0 +1,108 @@
+import time
+import threading
+
+from six.moves.urllib.parse import urlparse
+
+from blackboard.base import logger
+
+
+class AdaptiveRateLimiter:
+    """
+    Limit the number of requests per second sent to Blackboard.
+
+    The rate grows additively while responses are healthy, and is halved
+    when Blackboard answers 429 Too Many Requests or 503 Service
+    Unavailable, when a request fails, or when a response is much slower
+    than the fastest response seen for the same path. Responses to
+    requests that were sent before a decrease do not decrease the rate
+    again until `cooldown` seconds have passed. A Retry-After header
+    pauses all requests for the given number of seconds.
+
+    >>> now = [0.0]
+    >>> limiter = AdaptiveRateLimiter(4, clock=lambda: now[0])
+    >>> limiter.record('/a', 0.1, 200)
+    >>> limiter.rate
+    4.5
+    >>> limiter.record('/a', 1.0, 200)
+    >>> limiter.rate
+    2.25
+    >>> limiter.record('/a', None)
+    >>> limiter.rate
+    2.25
+    >>> now[0] += 5
+    >>> limiter.record('/a', 0.1, 429, retry_after='30')
+    >>> limiter.rate, limiter.delay()
+    (1.125, 30.0)
+    """
+
+    def __init__(self, rate=10.0, minimum=0.5, maximum=20.0, increase=0.5,
+                 slow_factor=4.0, cooldown=2.0, clock=time.monotonic):
+        self.rate = rate
+        self.minimum = minimum
+        self.maximum = maximum
+        self.increase = increase
+        self.slow_factor = slow_factor
+        self.cooldown = cooldown
+        self.clock = clock
+        self._lock = threading.Lock()
+        # Earliest time at which the next request may be sent
+        self._next = clock()
+        self._last_decrease = None
+        # Map URL path to the fastest response time seen
+        self._fastest = {}
+
+    def delay(self):
+        """Reserve a time slot for a request and return the number of
+        seconds to wait before sending it."""
+        with self._lock:
+            now = self.clock()
+            t = max(now, self._next)
+            self._next = t + 1 / self.rate
+            return t - now
+
+    def acquire(self):
+        """Wait until a request may be sent."""
+        delay = self.delay()
+        if delay > 0:
+            time.sleep(delay)
+
+    def record(self, url, elapsed, status=None, retry_after=None):
+        """Record that a request for url took elapsed seconds and
+        returned the given HTTP status.
+
+        Pass elapsed=None if the request failed.
+        """
+        path = urlparse(url).path
+        with self._lock:
+            now = self.clock()
+            if status in (429, 503):
+                self._decrease(now)
+                try:
+                    pause = float(retry_after)
+                except (TypeError, ValueError):
+                    pass
+                else:
+                    self._next = max(self._next, now + pause)
+                return
+            if elapsed is None:
+                self._decrease(now)
+                return
+            fastest = self._fastest.get(path)
+            if fastest is None or elapsed < fastest:
+                self._fastest[path] = fastest = elapsed
+            if elapsed > self.slow_factor * fastest:
+                self._decrease(now)
+            elif self.rate < self.maximum:
+                old = self.rate
+                self.rate = min(self.maximum, self.rate + self.increase)
+                if int(self.rate) != int(old):
+                    logger.debug("Request rate increased to %.1f/s",
+                                 self.rate)
+
+    def _decrease(self, now):
+        if (self._last_decrease is not None and
+                now - self._last_decrease < self.cooldown):
+            return
+        self._last_decrease = now
+        self.rate = max(self.minimum, self.rate / 2)
+        logger.debug("Request rate decreased to %.1f/s", self.rate)
@@ -1,20 +1,124 @@
 import re
+import time
+import random
+import threading
+import collections
+import concurrent.futures
 import getpass
 import keyring
-import html5lib
 import requests
+import requests.adapters
 import requests.cookies
+from requests.packages.urllib3.util.retry import Retry
 
 from six.moves.http_cookiejar import LWPCookieJar
 from six.moves.urllib.parse import urlparse, parse_qs, urlencode
 
 from blackboard.base import BadAuth, ParserError, logger, DOMAIN
+from blackboard.document import parse_document
+from blackboard.httpcache import HttpCache
+from blackboard.ratelimit import AdaptiveRateLimiter
 
 
 NS = {'h': 'http://www.w3.org/1999/xhtml'}
 
 
+def copy_response(response):
+    """Shallow copy of response whose history can be changed
+    without affecting the original.
+    The parsed document (see parse_document) is not copied, so that
+    responses kept by enable_get_memo do not keep their trees alive."""
+    copy = requests.Response()
+    copy.__dict__.update(response.__dict__)
+    copy.__dict__.pop('_bbfetch_document', None)
+    copy.history = list(response.history)
+    return copy
+
+
+class JitterRetry(Retry):
+    """Retry with "full jitter" exponential backoff, so that concurrent
+    workers that fail together do not retry in lockstep."""
+
+    def get_backoff_time(self):
+        return random.uniform(0, super().get_backoff_time())
+
+
+class TransportSession(requests.Session):
+    """
+    requests.Session with a connection pool sized for concurrent requests,
+    a default timeout, and retries of idempotent requests (GET, HEAD, ...)
+    on connection errors and 502/503/504 responses. POSTs are not retried
+    unless the connection could not be established. When the retries are
+    used up on 502/503/504, requests raises requests.exceptions.RetryError.
+    """
+
+    def __init__(self, pool_size=10, timeout=None, retries=0,
+                 retry_backoff=0.5, rate_limiter=None):
+        super().__init__()
+        self.timeout = timeout
+        # AdaptiveRateLimiter applied to every request, including
+        # each request of a redirect chain
+        self.rate_limiter = rate_limiter
+        self.configure(pool_size, retries, retry_backoff)
+
+    def configure(self, pool_size, retries, retry_backoff):
+        retry = JitterRetry(
+            total=retries, backoff_factor=retry_backoff,
+            status_forcelist=(502, 503, 504))
+        for prefix in ('https://', 'http://'):
+            self.mount(prefix, requests.adapters.HTTPAdapter(
+                pool_maxsize=pool_size, max_retries=retry))
+
+    def request(self, method, url, **kwargs):
+        if kwargs.get('timeout') is None:
+            kwargs['timeout'] = self.timeout
+        return super().request(method, url, **kwargs)
+
+    def send(self, request, **kwargs):
+        limiter = self.rate_limiter
+        if limiter is None:
+            return super().send(request, **kwargs)
+        limiter.acquire()
+        try:
+            response = super().send(request, **kwargs)
+        except (requests.ConnectionError, requests.Timeout,
+                requests.exceptions.RetryError):
+            limiter.record(request.url, None)
+            raise
+        limiter.record(request.url, response.elapsed.total_seconds(),
+                       response.status_code,
+                       response.headers.get('Retry-After'))
+        return response
+
+
 class BlackboardSession:
+    # Patterns of URLs whose responses may be reused from the HTTP cache
+    # for the given number of seconds without asking Blackboard.
+    # Other cached responses are revalidated with a conditional request.
+    http_cache_ttls = [
+        (r'/webapps/rubric/do/course/gradeRubric', 60 * 60),
+    ]
+
+    # Connections kept open to Blackboard; should be at least the number
+    # of concurrent requests.
+    pool_size = 10
+    # Seconds to wait for a connection and for data from Blackboard
+    connect_timeout = 15
+    read_timeout = 120
+    # Retries of idempotent requests, with exponential backoff
+    # (0.5 s, 1 s, 2 s, ... with jitter)
+    retries = 3
+    retry_backoff = 0.5
+    # Initial and maximal number of requests per second; the rate is
+    # lowered automatically when Blackboard throttles or slows down.
+    # Set to None to disable rate limiting.
+    rate_limit = 10.0
+    max_rate_limit = 20.0
+    # Cookies that expire when the Blackboard login expires, and the
+    # number of seconds before they expire to log in again.
+    login_cookies = ('BbRouter', 's_session_id')
+    login_renew_margin = 5 * 60
+
     def __init__(self, cookiejar, username, course_id):
         self.cookiejar_filename = cookiejar
         self.username = username
@@ -22,9 +126,64 @@ class BlackboardSession:
 
         self.password = None
         self.cookies = LWPCookieJar(cookiejar)
-        self.session = requests.Session()
+        self.session = TransportSession(
+            self.pool_size, (self.connect_timeout, self.read_timeout),
+            self.retries, self.retry_backoff)
+        if self.rate_limit is not None:
+            self.session.rate_limiter = AdaptiveRateLimiter(
+                self.rate_limit, maximum=self.max_rate_limit)
+        self.http_cache = None
+        # Number of times get() accepted a redirected response
+        # instead of fetching the requested URL again
+        self.refetches_avoided = 0
+        # Only one thread logs in at a time (see login_once);
+        # login_generation counts the completed logins.
+        self._login_lock = threading.RLock()
+        self.login_generation = 0
+        self._renewed_expiry = None
+        # Map URL to Future of the response (see enable_get_memo)
+        self._get_memo = None
+        self._get_memo_lock = threading.Lock()
         self.load_cookies()
 
+    def configure_transport(self, pool_size=None, timeout=None,
+                            retries=None):
+        """Change the connection pool size, the read timeout in seconds,
+        or the number of retries of idempotent requests."""
+        if pool_size is not None:
+            self.pool_size = pool_size
+        if timeout is not None:
+            self.read_timeout = timeout
+        if retries is not None:
+            self.retries = retries
+        self.session.timeout = (self.connect_timeout, self.read_timeout)
+        self.session.configure(self.pool_size, self.retries,
+                               self.retry_backoff)
+
+    def enable_get_memo(self, maxsize=32, maxbytes=32 * 2 ** 20):
+        """Reuse the responses to GET requests until the next POST.
+
+        Concurrent GETs of the same URL are sent only once, and the
+        `maxsize` most recently completed responses, but no more than
+        `maxbytes` bytes of response bodies, are kept for later GETs. The memo is cleared by every POST (except DWR calls, which
+        only read data) and when switching to edit mode, so it is meant
+        to be enabled for a single run of a command.
+        Pages with a form nonce must be fetched with fetch() instead,
+        since two forms built from one response would share the nonce.
+        """
+        self._get_memo_maxsize = maxsize
+        self._get_memo_maxbytes = maxbytes
+        self._get_memo = collections.OrderedDict()
+
+    def clear_get_memo(self):
+        if self._get_memo is not None:
+            with self._get_memo_lock:
+                self._get_memo.clear()
+
+    def enable_http_cache(self, filename):
+        """Cache GET responses on disk in the SQLite database filename."""
+        self.http_cache = HttpCache(filename, self.http_cache_ttls)
+
     def load_cookies(self):
         try:
             self.cookies.load(ignore_discard=True)
@@ -94,7 +253,7 @@ class BlackboardSession:
         url = (
             'https://%s/webapps/bb-auth-provider-shibboleth-BBLEARN' % DOMAIN +
             '/execute/shibbolethLogin?authProviderId=_102_1')
-        response = self.get(url)
+        response = self.fetch(url)
         if self.detect_login(response) is False:
             logger.error("Seems logged out after re-login. " +
                          "Try deleting your cookiejar.")
@@ -102,7 +261,7 @@ class BlackboardSession:
         return response
 
     def detect_login(self, response):
-        document = html5lib.parse(response.content, transport_encoding=response.encoding)
+        document = parse_document(response)
         log_in_id = 'topframe.login.label'
         o = document.find('.//h:a[@id="%s"]' % log_in_id, NS)
         if o is not None:
@@ -121,7 +280,7 @@ class BlackboardSession:
             Page containing form with only hidden fields
         """
 
-        document = html5lib.parse(response.content, transport_encoding=response.encoding)
+        document = parse_document(response)
         form = document.find('.//h:form', NS)
         url = form.get('action')
         inputs = form.findall('.//h:input[@name]', NS)
@@ -154,8 +313,7 @@ class BlackboardSession:
         history = list(response.history) + [response]
 
         while True:
-            document = html5lib.parse(
-                response.content, transport_encoding=response.encoding)
+            document = parse_document(response)
             scripts = document.findall('.//h:script', NS)
 
             next_url = None
@@ -192,22 +350,80 @@ class BlackboardSession:
         response.history = history[:-1]
         return response
 
-    def autologin(self, response):
+    def login_once(self, login, generation=None):
+        """Call login() unless another thread has logged in since
+        login_generation had the value generation.
+
+        Concurrent requests that find the session expired all call
+        login_once with the generation read before they were sent;
+        the first one logs in while the others wait, and then they
+        return None without logging in again, so that the caller can
+        retry its request with the new cookies.
+        """
+        with self._login_lock:
+            if (generation is not None and
+                    generation != self.login_generation):
+                logger.debug("Already logged in by another request")
+                return None
+            response = login()
+            self.login_generation += 1
+            return response
+
+    def autologin(self, response, generation=None):
         """Automatically log in if necessary.
 
         If the given response is not for a login form,
         just follow HTML redirects and return the response.
-        Otherwise, log in using wayf_login and get_auth.
+        Otherwise, log in using wayf_login and get_auth,
+        or, if another thread logged in after generation (see login_once),
+        fetch the originally requested page again.
         """
 
         response = self.follow_html_redirect(response)
         o = urlparse(response.url)
         if o.netloc == 'wayf.au.dk':
-            response = self.wayf_login(response)
+            form_response = response
+            response = self.login_once(
+                lambda: self.wayf_login(form_response), generation)
+            if response is None:
+                history = (list(form_response.history) +
+                           [form_response])
+                response = self.follow_html_redirect(
+                    self.session.get(history[0].url))
+                response.history = history + list(response.history)
         return response
 
+    def get_login_expiry(self):
+        """Return the time at which the login cookies expire,
+        or None if they are not set or expire with the browser session."""
+        try:
+            cookies = list(self.session.cookies)
+        except RuntimeError:
+            # Modified by another thread
+            return None
+        expiry = [c.expires for c in cookies
+                  if c.name in self.login_cookies and c.expires]
+        return min(expiry) if expiry else None
+
+    def renew_login(self):
+        """Log in again if the login cookies are about to expire."""
+        expiry = self.get_login_expiry()
+        if expiry is None or expiry == self._renewed_expiry:
+            return
+        if expiry - time.time() > self.login_renew_margin:
+            return
+        generation = self.login_generation
+        with self._login_lock:
+            if self._renewed_expiry == expiry:
+                return
+            # Don't try again if the login doesn't extend the expiry
+            self._renewed_expiry = expiry
+            logger.debug("Login expires in %d s; logging in again",
+                         expiry - time.time())
+            self.login_once(self.relogin, generation)
+
     def get_edit_mode(self, response):
-        document = html5lib.parse(response.content, transport_encoding=response.encoding)
+        document = parse_document(response)
         mode_switch = document.find('.//*[@id="editModeToggleLink"]', NS)
         if mode_switch is not None:
             return 'read-on' in (mode_switch.get('class') or '').split()
@@ -219,7 +435,8 @@ class BlackboardSession:
                    '&courseId=' + self.course_id +
                    '&mode=designer')
             logger.debug("Switch to edit mode")
-            r = self.get(url)
+            r = self.fetch(url)
+            self.clear_get_memo()
             history = (list(response.history) + [response] +
                        list(r.history) + [r])
             response = self.get(history[0].url)
@@ -227,22 +444,131 @@ class BlackboardSession:
         return response
 
     def get(self, url):
-        response = self.autologin(self.session.get(url))
+        memo = self._get_memo
+        if memo is None:
+            return self.fetch(url)
+        with self._get_memo_lock:
+            future = memo.get(url)
+            if future is None:
+                future = memo[url] = concurrent.futures.Future()
+                owner = True
+            else:
+                memo.move_to_end(url)
+                owner = False
+        if not owner:
+            logger.debug("Reusing response for %s", url)
+            return copy_response(future.result())
+        try:
+            response = self.fetch(url)
+        except BaseException as exn:
+            with self._get_memo_lock:
+                if memo.get(url) is future:
+                    del memo[url]
+            future.set_exception(exn)
+            raise
+        # Keep a copy without the parsed document in the memo
+        stored = copy_response(response)
+        with self._get_memo_lock:
+            if response.status_code != 200 and memo.get(url) is future:
+                del memo[url]
+            done = [(k, stored if f is future else f.result())
+                    for k, f in memo.items() if f.done() or f is future]
+            count = len(done)
+            size = sum(len(r.content) for k, r in done)
+            for k, r in done:
+                if (count <= self._get_memo_maxsize and
+                        size <= self._get_memo_maxbytes):
+                    break
+                del memo[k]
+                count -= 1
+                size -= len(r.content)
+        future.set_result(stored)
+        return response
+
+    def fetch(self, url):
+        """GET url, logging in if necessary, without using the memo
+        of enable_get_memo."""
+        self.renew_login()
+        generation = self.login_generation
+        return self.cached_get(
+            url, lambda url, response:
+            self._login_get(url, response, generation))
+
+    def cached_get(self, url, handle):
+        """GET url through the HTTP cache, if it is enabled.
+
+        handle(url, response) is called on responses from Blackboard
+        (but not on responses from the cache) and returns the response
+        to use, e.g. after logging in. A response is stored in the cache
+        only if it is a successful response from url itself, so pages that
+        redirected to a login form are never stored.
+        """
+
+        cache = self.http_cache
+        if cache is None:
+            return handle(url, self.session.get(url))
+        key = '%s %s' % (self.course_id, url)
+        entry = cache.lookup(key)
+        headers = {}
+        if entry is not None:
+            if entry.is_fresh():
+                logger.debug("Cached %s", url)
+                return entry.to_response()
+            headers = entry.conditional_headers()
+        response = self.session.get(url, headers=headers)
+        if (response.status_code == 304 and entry is not None and
+                not response.history):
+            logger.debug("Not modified %s", url)
+            cache.touch(key)
+            return entry.to_response()
+        response = handle(url, response)
+        if response.status_code == 200 and response.url == url:
+            cache.store(key, response)
+        return response
+
+    def is_login_bounce(self, response):
+        """Return True if response was redirected through a login page.
+
+        After logging in, Blackboard often lands on a different page than
+        the one requested, so the requested page must be fetched again.
+        Other redirects (e.g. adding a trailing slash) are harmless.
+        """
+        for r in list(response.history) + [response]:
+            o = urlparse(r.url)
+            if o.netloc == 'wayf.au.dk':
+                return True
+            if o.path.startswith(('/webapps/login/',
+                                  '/webapps/bb-auth-provider-shibboleth')):
+                return True
+        return False
+
+    def _login_get(self, url, response, generation):
+        response = self.autologin(response, generation)
         if self.detect_login(response) is False:
             history = response.history + [response]
-            relogin_response = self.relogin()
-            history += relogin_response.history + [relogin_response]
+            relogin_response = self.login_once(self.relogin, generation)
+            if relogin_response is not None:
+                history += relogin_response.history + [relogin_response]
             response = self.autologin(self.session.get(url))
+            bounced = self.is_login_bounce(response)
             response.history = history + list(response.history)
+        else:
+            bounced = self.is_login_bounce(response)
         if response.url != url:
-            history = list(response.history) + [response]
-            response = self.session.get(url)
-            response.history = history + list(response.history)
+            if bounced:
+                history = list(response.history) + [response]
+                response = self.session.get(url)
+                response.history = history + list(response.history)
+            else:
+                self.refetches_avoided += 1
+                logger.debug("Accepting redirect from %s to %s " +
+                             "(%d refetches avoided)", url, response.url,
+                             self.refetches_avoided)
         self.log_error(response)
         return response
 
     def log_error(self, response):
-        document = html5lib.parse(response.content, transport_encoding=response.encoding)
+        document = parse_document(response)
         content = document.find('.//h:div[@id="contentPanel"]', NS)
         if content is not None:
             class_list = (content.get('class') or '').split()
@@ -250,7 +576,12 @@ class BlackboardSession:
                 logger.info("contentPanel indicates an error has occurred")
                 # raise ParserError("Error", response)
 
-    def post(self, url, data, files=None, headers=None):
+    def post(self, url, data, files=None, headers=None, invalidate=True):
+        """Send a POST request. Unless invalidate is False, the request
+        is assumed to change data on Blackboard, so that the responses
+        reused by get (see enable_get_memo) are discarded."""
+        if invalidate:
+            self.clear_get_memo()
         response = self.session.post(
             url, data=data, files=files, headers=headers)
         # if response.history:
@@ -0,0 +1,196 @@
+import sys
+import json
+import sqlite3
+import argparse
+import collections
+
+
+def is_store_filename(filename):
+    """True if the state file should be stored with SqliteStore."""
+    return filename.endswith(('.sqlite3', '.sqlite', '.db'))
+
+
+class SqliteStore:
+    """
+    Store the state of a Serializable (e.g. Grading) in an SQLite database.
+
+    The state is the same object that Serializable.save writes as JSON:
+    a dictionary with 'time', 'course' and 'payload'. Most fields are
+    stored as one JSON value per field, but the dictionaries listed in
+    ROW_TABLES (the attempt states and the gradebook students) are stored
+    with one row per key, so that a small change only rewrites the
+    affected rows instead of the whole state.
+
+    >>> store = SqliteStore(':memory:')
+    >>> store.save({'time': 1, 'payload': {
+    ...     'username': 'au123', 'attempt_state': {'_1_1': {'score': 1}},
+    ...     'gradebook': {'_students': {'_2_1': {}}, 'fetch_time': 2}}})
+    5
+    >>> store.save({'time': 1, 'payload': {
+    ...     'username': 'au123', 'attempt_state': {'_1_1': {'score': 0}},
+    ...     'gradebook': {'_students': {'_2_1': {}}, 'fetch_time': 2}}})
+    1
+    >>> dict(store.load()['payload']['attempt_state'])
+    {'_1_1': {'score': 0}}
+    """
+
+    # Paths of objects in the state that are dictionaries of fields
+    NESTED = ('payload', 'payload/gradebook')
+    # Paths of dictionaries stored as one row per key
+    ROW_TABLES = collections.OrderedDict([
+        ('payload/attempt_state', 'attempt'),
+        ('payload/gradebook/_students', 'student'),
+    ])
+
+    def __init__(self, filename):
+        self.filename = filename
+        self._db = sqlite3.connect(filename)
+        with self._db:
+            self._db.execute('CREATE TABLE IF NOT EXISTS field ' +
+                             '(path TEXT PRIMARY KEY, value TEXT NOT NULL)')
+            for table in self.ROW_TABLES.values():
+                self._db.execute('CREATE TABLE IF NOT EXISTS %s ' % table +
+                                 '(key TEXT PRIMARY KEY, value TEXT NOT NULL)')
+        # The JSON strings currently in the database,
+        # so that unchanged fields and rows are not written again.
+        self._written = self._read()
+
+    def close(self):
+        self._db.close()
+
+    def _read(self):
+        written = {
+            'field': dict(self._db.execute('SELECT path, value FROM field')),
+        }
+        for table in self.ROW_TABLES.values():
+            written[table] = dict(
+                self._db.execute('SELECT key, value FROM %s' % table))
+        return written
+
+    def is_empty(self):
+        return not self._written['field']
+
+    def load(self):
+        """Return the stored state, or None if the store is empty."""
+        if self.is_empty():
+            return None
+        o = collections.OrderedDict()
+
+        def container(path):
+            d = o
+            for k in path.split('/'):
+                d = d.setdefault(k, collections.OrderedDict())
+            return d
+
+        for path, value in self._written['field'].items():
+            parent, _, k = path.rpartition('/')
+            d = container(parent) if parent else o
+            d[k] = json.loads(value)
+        for path, table in self.ROW_TABLES.items():
+            rows = self._written[table]
+            container(path).update(
+                (k, json.loads(v)) for k, v in sorted(rows.items()))
+        return o
+
+    def save(self, o, dirty=None):
+        """Write the state o to the database.
+
+        If dirty is None, every field and row is compared with the
+        database contents. Otherwise, dirty maps a path in ROW_TABLES to
+        the set of keys that may have changed (or to None, meaning that
+        any key may have changed), and row tables not mentioned in dirty
+        are assumed to be unchanged.
+
+        Return the number of fields and rows written or deleted.
+        """
+        fields = []
+        rows = {}
+
+        def visit(path, d):
+            for k, v in d.items():
+                p = '%s/%s' % (path, k) if path else k
+                if p in self.ROW_TABLES:
+                    rows[p] = v
+                elif p in self.NESTED:
+                    visit(p, v)
+                else:
+                    fields.append((p, v))
+
+        visit('', o)
+        n = 0
+        with self._db:
+            written = self._written['field']
+            for path, value in fields:
+                s = json.dumps(value)
+                if written.get(path) != s:
+                    self._db.execute(
+                        'INSERT OR REPLACE INTO field VALUES (?, ?)',
+                        (path, s))
+                    written[path] = s
+                    n += 1
+            for path, table in self.ROW_TABLES.items():
+                value = rows.get(path) or {}
+                if dirty is None or dirty.get(path, ()) is None:
+                    keys = set(value) | set(self._written[table])
+                else:
+                    keys = dirty.get(path, ())
+                n += self._save_rows(table, value, keys)
+        return n
+
+    def _save_rows(self, table, value, keys):
+        written = self._written[table]
+        n = 0
+        for k in keys:
+            try:
+                v = value[k]
+            except KeyError:
+                if k in written:
+                    self._db.execute('DELETE FROM %s WHERE key = ?' % table,
+                                     (k,))
+                    del written[k]
+                    n += 1
+                continue
+            s = json.dumps(v)
+            if written.get(k) != s:
+                self._db.execute(
+                    'INSERT OR REPLACE INTO %s VALUES (?, ?)' % table, (k, s))
+                written[k] = s
+                n += 1
+        return n
+
+    def import_json(self, filename):
+        """Store the contents of the given JSON state file."""
+        with open(filename) as fp:
+            o = json.load(fp, object_pairs_hook=collections.OrderedDict)
+        self.save(o)
+
+    def export_json(self, filename):
+        """Write the contents of the store as a JSON state file."""
+        o = self.load()
+        if o is None:
+            raise ValueError("%s is empty" % self.filename)
+        with open(filename, 'w') as fp:
+            json.dump(o, fp, indent=2)
+
+
+def main():
+    parser = argparse.ArgumentParser(
+        description='Convert between JSON and SQLite grading state')
+    parser.add_argument('action', choices=('import', 'export'))
+    parser.add_argument('json_file')
+    parser.add_argument('db_file')
+    args = parser.parse_args()
+    if not is_store_filename(args.db_file):
+        parser.error("%s must end in .sqlite3, .sqlite or .db" % args.db_file)
+    store = SqliteStore(args.db_file)
+    try:
+        if args.action == 'import':
+            store.import_json(args.json_file)
+        else:
+            store.export_json(args.json_file)
+    finally:
+        store.close()
+
+
+if __name__ == '__main__':
+    sys.exit(main())
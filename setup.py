@@ -25,6 +25,11 @@ setup(
         'six',
         'html5lib==0.999999999',
     ],
+    extras_require={
+        # C implementation of the HTML5 parser; used instead of
+        # html5lib when installed.
+        'fast': ['html5-parser'],
+    },
     classifiers=[
         'Intended Audience :: Developers',
         'Operating System :: OS Independent',